@@ -1,10 +1,14 @@
 ###code.interact(local=dict(globals(), **locals()))
 #!/usr/bin/env python3
 
-import os
 import pyradUtilities as utils
 import pyradLineshape as ls
 import pyradIntensity
+import pyradCrossSection
+import pyradLookup
+import pyradKDistribution
+import pyradTransfer
+import pyradProfiles
 import pyradPlanck
 import numpy as np
 import matplotlib.pyplot as plt
@@ -21,6 +25,9 @@ t0 = 296
 p0 = 1013.25
 t0 = 296
 avo = 6.022140857E23
+#   largest relative change of any lorentz width a concentration edit may cause before the cross section of
+#   an isotope is recomputed. Below it the cached cross section is kept, since absCoef scales with concentration.
+CONCENTRATION_WIDTH_TOLERANCE = 1E-3
 
 
 def integrateSpectrum(spectrum, unitAngle=pi, res=utils.BASE_RESOLUTION):
@@ -36,13 +43,14 @@ def getCrossSection(obj):
 
 
 def resetCrossSection(obj):
-    if not isinstance(obj, Layer):
-        if not obj.exotic:
-            obj.crossSection = np.zeros(int((obj.rangeMax - obj.rangeMin) / utils.BASE_RESOLUTION))
-            obj.progressCrossSection = False
+    # layers have no exotic flag, their cross section is the sum of their molecules' and is always rebuilt
+    if isinstance(obj, Layer) or not obj.exotic:
+        obj.crossSection = np.zeros(int((obj.rangeMax - obj.rangeMin) / utils.BASE_RESOLUTION))
+        obj.progressCrossSection = False
+    if isinstance(obj, Isotope):
+        return
     for child in obj:
-        if not isinstance(child, Line):
-            resetCrossSection(child)
+        resetCrossSection(child)
 
 
 def resetData(obj):
@@ -50,14 +58,140 @@ def resetData(obj):
     # use this if layer ranges get changed. Will also clear the cross section data of the obj.
     for child in obj:
         if isinstance(child, Isotope):
-            while len(child) > 0:
-                child.pop()
+            child.clearLines()
             child.getData()
         else:
             resetData(child)
     resetCrossSection(obj)
 
 
+def resetLineSurvey(obj):
+    # rebuilds the line surveys from the lines already loaded, after the range or resolution changed
+    if isinstance(obj, Isotope):
+        if not obj.exotic:
+            obj.createLineSurvey()
+        return
+    for child in obj:
+        resetLineSurvey(child)
+
+
+def compareCrossSectionMethods(obj, method='fft', reference='direct'):
+    # computes every isotope below obj with both methods and reports the error of method against reference
+    errors = {}
+    if isinstance(obj, Isotope):
+        if obj.exotic:
+            return errors
+        maxError, rmsError = pyradCrossSection.relativeError(obj.computeCrossSection(method),
+                                                             obj.computeCrossSection(reference))
+        print('%s %s: %s vs %s, max error %.3e, rms error %.3e (relative to peak)'
+              % (obj.molecule.name, obj.name, method, reference, maxError, rmsError))
+        errors['%s %s' % (obj.molecule.name, obj.name)] = (maxError, rmsError)
+        return errors
+    for child in obj:
+        errors.update(compareCrossSectionMethods(child, method, reference))
+    return errors
+
+
+def createCrossSectionsParallel(layer):
+    # computes every isotope of the layer still missing a cross section over a pool of layer.workers
+    # processes, in (isotope, spectral chunk) work units. The molecules then sum their isotopes as usual.
+    # With tiles, isotopes missing any tile of the layer range compute every tile of it.
+    method = layer.crossSectionMethod
+    gridOffset, gridLength = layer.engineGrid()
+    isotopes = []
+    jobs = []
+    for molecule in layer:
+        for isotope in molecule:
+            if isinstance(isotope, Isotope) and not isotope.exotic and not isotope.progressCrossSection:
+                if isotope.lookupCrossSection() is not None or isotope.tilesCached(method):
+                    isotope.createCrossSection()
+                    continue
+                isotopes.append(isotope)
+                jobs.append((method,) + isotope.engineInputs())
+    if not jobs:
+        return
+    print('Processing %s cross section for %s isotopes on %s workers' % (method, len(jobs), layer.workers))
+    crossSections = pyradCrossSection.parallelCrossSections(jobs, 0, layer.resolution, gridLength,
+                                                            layer.workers, gridOffset=gridOffset)
+    for isotope, crossSection in zip(isotopes, crossSections):
+        if layer.tileWidth:
+            tileSamples = pyradCrossSection.tileSpan(layer.rangeMin, layer.rangeMax, layer.resolution,
+                                                     layer.tileWidth)[2]
+            isotope.storeTiles(isotope.tiles(method), gridOffset // tileSamples, crossSection, tileSamples)
+        isotope.crossSection = isotope.toXAxis(crossSection, gridOffset)
+        isotope.progressCrossSection = True
+        isotope.crossSectionConcentration = isotope.molecule.concentration
+
+
+def shareLineData(isotopes):
+    # loads the lines of isotopes, the same isotope in different layers, once over the effective ranges of all
+    # their layers and gives every one of them the same LineTable. Nothing is loaded if they already share a
+    # table covering those ranges. Returns the table.
+    rangeMin = min(isotope.layer.effectiveRangeMin for isotope in isotopes)
+    rangeMax = max(isotope.layer.effectiveRangeMax for isotope in isotopes)
+    table = isotopes[0].lineTable
+    if all(isotope.lineTable is table for isotope in isotopes) and table.loadedRange \
+            and table.loadedRange[0] <= rangeMin and rangeMax <= table.loadedRange[1]:
+        return table
+    globalIsoNumber = isotopes[0].globalIsoNumber
+    print('Getting data for %s, isotope %s, shared by %s layers' % (isotopes[0].molecule.name, globalIsoNumber,
+                                                                   len(isotopes)))
+    table = LineTable(**utils.gatherData(globalIsoNumber, rangeMin, rangeMax))
+    table.loadedRange = (rangeMin, rangeMax)
+    utils.getQTable(globalIsoNumber)
+    for isotope in isotopes:
+        isotope.lineTable = table
+        isotope.createLineSurvey()
+    return table
+
+
+def createCrossSectionsBatched(atmosphere):
+    # computes the direct cross sections of the layers of atmosphere together, one pass over the lines per
+    # isotope for every group of layers sharing a grid. The lines are loaded once over the range of the whole
+    # group and the same LineTable is shared by the isotopes of its layers. The line parameters are layers x
+    # lines arrays. Tiled layers store the batch in their tiles. Layers that prune lines or use another method,
+    # and isotopes with a lookup table or every tile cached, are left to Layer.createCrossSection.
+    groups = {}
+    for layer in atmosphere:
+        if layer.crossSectionMethod == 'direct' and not layer.pruneAbsorbance:
+            groups.setdefault(layer.engineGrid() + (layer.resolution,), []).append(layer)
+    for (gridOffset, gridLength, resolution), layers in groups.items():
+        isotopeGroups = {}
+        for layer in layers:
+            for molecule in layer:
+                for isotope in molecule:
+                    if isinstance(isotope, Isotope) and not isotope.exotic and not isotope.progressCrossSection \
+                            and isotope.lookupCrossSection() is None and not isotope.tilesCached('direct'):
+                        isotopeGroups.setdefault(isotope.globalIsoNumber, []).append(isotope)
+        for globalIsoNumber, isotopes in isotopeGroups.items():
+            if len(isotopes) < 2:
+                continue
+            print('Processing batched direct cross section for isotope %s in %s layers'
+                  % (globalIsoNumber, len(isotopes)))
+            table = shareLineData(isotopes)
+            T = np.array([[isotope.layer.T] for isotope in isotopes])
+            P = np.array([[isotope.layer.P] for isotope in isotopes])
+            concentration = np.array([[isotope.molecule.concentration] for isotope in isotopes])
+            q = utils.partitionFunction(globalIsoNumber, T)
+            gaussianHW = table.gaussianHW(T, P, isotopes[0].molMass)
+            lorentzHW = table.lorentzHW(T, P, concentration)
+            intensity = pyradIntensity.intensityFactor(table.intensity, table.broadenedLine(P), T,
+                                                       table.lowerEnergy, q, isotopes[0].q296)
+            cutoffs = np.array([np.broadcast_to(isotope.layer.lineCutoffs(intensity[i], gaussianHW[i], lorentzHW[i]),
+                                                (len(table),)) for i, isotope in enumerate(isotopes)])
+            crossSections = pyradCrossSection.lineByLineLayers(table.wavenumber, intensity, gaussianHW, lorentzHW,
+                                                               0, resolution, gridLength, cutoffs,
+                                                               gridOffset=gridOffset)
+            for isotope, crossSection in zip(isotopes, crossSections):
+                if isotope.layer.tileWidth:
+                    tileSamples = pyradCrossSection.tileSpan(isotope.rangeMin, isotope.rangeMax, resolution,
+                                                             isotope.layer.tileWidth)[2]
+                    isotope.storeTiles(isotope.tiles('direct'), gridOffset // tileSamples, crossSection, tileSamples)
+                isotope.crossSection = isotope.toXAxis(crossSection, gridOffset)
+                isotope.progressCrossSection = True
+                isotope.crossSectionConcentration = isotope.molecule.concentration
+
+
 def getAbsCoef(obj):
     if not obj.progressCrossSection:
         obj.createCrossSection()
@@ -109,6 +243,81 @@ def totalConcentration(layer):
     return total
 
 
+def buildLookupTable(name, rangeMin, rangeMax, temperatures, pressures, isotopeDepth=1, method='direct', ppm=1,
+                     cutoffThreshold=pyradCrossSection.CUTOFF_THRESHOLD, relativeCutoff=True, components=None):
+    # precomputes the cross section of every isotope of molecule name over a grid of temperatures (K) and
+    # pressures (mbar), and saves one memory mapped lookup table per isotope. The tables are loaded next to any
+    # loaded before, so layers within the grid get their cross sections by interpolation from then on, as long
+    # as they use the same method and cutoffs and a concentration whose self broadening is within
+    # CONCENTRATION_WIDTH_TOLERANCE of ppm, see Isotope.lookupCrossSection.
+    # With components, each table is also compressed to that many principal components and loaded compressed.
+    temperatures = np.sort(np.asarray(temperatures, dtype=float))
+    pressures = np.sort(np.asarray(pressures, dtype=float))
+    layer = Layer(1, temperatures[-1], pressures[-1], rangeMin, rangeMax, name='lookup %s' % name,
+                  crossSectionMethod=method, cutoffThreshold=cutoffThreshold, relativeCutoff=relativeCutoff,
+                  tileWidth=None)
+    molecule = layer.addMolecule(name, isotopeDepth, ppm=ppm)
+    if molecule.exotic:
+        print('%s has no line data to build a lookup table from' % name)
+        return []
+    tableNames = []
+    tables = []
+    for isotope in molecule:
+        tableName = '%s_%s_%s-%s_%s_%sppm_cutoff%s%s' % (name, isotope.globalIsoNumber, rangeMin, rangeMax, method,
+                                                        ppm, cutoffThreshold, 'relative' if relativeCutoff else '')
+        tableNames.append(tableName)
+        tables.append(pyradLookup.createTable(tableName, isotope.globalIsoNumber, temperatures, pressures,
+                                              layer.xAxis, molecule.concentration, method, cutoffThreshold,
+                                              relativeCutoff))
+    # the widest pressure first, so the line data loaded for it covers every other grid point
+    for pIndex in range(len(pressures) - 1, -1, -1):
+        layer.changePressure(pressures[pIndex])
+        for tIndex in range(len(temperatures) - 1, -1, -1):
+            layer.changeTemperature(temperatures[tIndex])
+            print('Lookup table for %s: %sK, %smbar' % (name, temperatures[tIndex], pressures[pIndex]))
+            for isotope, table in zip(molecule, tables):
+                table[tIndex, pIndex] = isotope.computeCrossSection(method)
+    for tableName, table in zip(tableNames, tables):
+        table.flush()
+        if components:
+            pyradLookup.compressTable(tableName, components)
+        else:
+            pyradLookup.loadTable(tableName)
+    return tableNames
+
+
+def buildAtmosphere(name, profile, rangeMin, rangeMax, layerCount=30, top=None, molecules=('h2o', 'co2', 'o3'),
+                    isotopeDepth=1, **layerOptions):
+    # an Atmosphere of layerCount layers with hydrostatic depths, split from profile up to top (km), see
+    # pyradProfiles.layerProfile. profile is a profile dict, the name of a standard profile or a csv file.
+    # Every layer gets molecules at the profile mixing ratios, and the lines of each isotope are loaded once for
+    # all layers. layerOptions are passed on to Atmosphere.addLayer.
+    if isinstance(profile, str):
+        if profile in pyradProfiles.STANDARD_PROFILES:
+            profile = pyradProfiles.standardProfile(profile)
+        else:
+            profile = pyradProfiles.readProfileFile(profile)
+        if not profile:
+            return False
+    missing = [molecule for molecule in molecules if molecule not in profile['ppm']]
+    if missing:
+        print('Profile %s has no mixing ratio for %s' % (profile['name'], ', '.join(missing)))
+        return False
+    atmosphere = Atmosphere(name)
+    isotopeGroups = {}
+    for layerValues in pyradProfiles.layerProfile(profile, layerCount, top):
+        layer = atmosphere.addLayer(layerValues['depth'], layerValues['T'], layerValues['P'], rangeMin, rangeMax,
+                                    **layerOptions)
+        for moleculeName in molecules:
+            molecule = layer.addMolecule(moleculeName, isotopeDepth, loadData=False,
+                                         ppm=layerValues['ppm'][moleculeName])
+            for isotope in molecule:
+                isotopeGroups.setdefault(isotope.globalIsoNumber, []).append(isotope)
+    for isotopes in isotopeGroups.values():
+        shareLineData(isotopes)
+    return atmosphere
+
+
 def totalLineList(obj):
     fullList = []
     if isinstance(obj, Isotope):
@@ -234,41 +443,105 @@ def mergeArray(newX, oldX, oldY):
 
 
 
+class LineTable:
+    # the lines of an isotope as one array per HITRAN parameter, about 64 bytes per line. The quantities that
+    # depend on the layer are computed for every line at once, or for index, a line or a slice of them.
+    columns = ('wavenumber', 'intensity', 'einsteinA', 'airHalfWidth', 'selfHalfWidth', 'lowerEnergy',
+               'tempExponent', 'pressureShift')
+
+    def __init__(self, wavenumber=(), intensity=(), einsteinA=(), airHalfWidth=(), selfHalfWidth=(),
+                 lowerEnergy=(), tempExponent=(), pressureShift=()):
+        self.wavenumber = np.asarray(wavenumber, dtype=float)
+        self.intensity = np.asarray(intensity, dtype=float)
+        self.einsteinA = np.asarray(einsteinA, dtype=float)
+        self.airHalfWidth = np.asarray(airHalfWidth, dtype=float)
+        self.selfHalfWidth = np.asarray(selfHalfWidth, dtype=float)
+        self.lowerEnergy = np.asarray(lowerEnergy, dtype=float)
+        self.tempExponent = np.asarray(tempExponent, dtype=float)
+        self.pressureShift = np.asarray(pressureShift, dtype=float)
+        # derived arrays with the state they were computed for, see cached
+        self.cache = {}
+        # (rangeMin, rangeMax) the lines were loaded for when shared between layers, see shareLineData
+        self.loadedRange = None
+
+    def __len__(self):
+        return len(self.wavenumber)
+
+    def cached(self, name, state, compute):
+        # returns the array called name for state, a tuple of the layer variables it depends on, computing it
+        # only if that state changed. A temperature change then leaves the pressure only quantities alone.
+        if name not in self.cache or self.cache[name][0] != state:
+            self.cache[name] = (state, compute())
+        return self.cache[name][1]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.columns)
+
+    def broadenedLine(self, P, index=slice(None)):
+        return self.wavenumber[index] + self.pressureShift[index] * P / p0
+
+    def lorentzHW(self, T, P, concentration, index=slice(None)):
+        return (((1 - concentration) * self.airHalfWidth[index] + concentration * self.selfHalfWidth[index])
+                * (P / p0) * (t0 / T) ** self.tempExponent[index])
+
+    def gaussianHW(self, T, P, molMass, index=slice(None)):
+        return self.broadenedLine(P, index) * np.sqrt(2 * k * T / molMass / c ** 2)
+
+
+def lineColumn(column):
+    # a Line property that reads its row of one LineTable column
+    return property(lambda line: float(getattr(line.isotope.lineTable, column)[line.index]))
+
+
 class Line:
-    def __init__(self, wavenumber, intensity, einsteinA, airHalfWidth,
-                 selfHalfWidth, lowerEnergy, tempExponent, pressureShift, parent):
-        self.isotope = parent
-        self.molecule = self.isotope.molecule
-        self.layer = self.molecule.layer
-        self.wavenumber = wavenumber
-        self.intensity = intensity
-        self.einsteinA = einsteinA
-        self.airHalfWidth = airHalfWidth
-        self.selfHalfWidth = selfHalfWidth
-        self.lowerEnergy = lowerEnergy
-        self.tempExponent = tempExponent
-        self.pressureShift = pressureShift
+    # a view of one row of its isotope's LineTable, for code that works line by line
+    __slots__ = ('isotope', 'index')
+
+    def __init__(self, isotope, index):
+        self.isotope = isotope
+        self.index = index
+
+    wavenumber = lineColumn('wavenumber')
+    intensity = lineColumn('intensity')
+    einsteinA = lineColumn('einsteinA')
+    airHalfWidth = lineColumn('airHalfWidth')
+    selfHalfWidth = lineColumn('selfHalfWidth')
+    lowerEnergy = lineColumn('lowerEnergy')
+    tempExponent = lineColumn('tempExponent')
+    pressureShift = lineColumn('pressureShift')
+
+    @property
+    def molecule(self):
+        return self.isotope.molecule
+
+    @property
+    def layer(self):
+        return self.isotope.layer
 
     @property
     def broadenedLine(self):
-        return self.wavenumber + self.pressureShift * self.layer.P / p0
+        return float(self.isotope.lineTable.broadenedLine(self.layer.P, self.index))
 
     @property
     def lorentzHW(self):
-        return (float((1 - self.molecule.concentration) * self.airHalfWidth + self.molecule.concentration
-                * self.selfHalfWidth) * (self.layer.P / p0) * (t0 / self.layer.T) ** self.tempExponent)
+        return float(self.isotope.lineTable.lorentzHW(self.layer.T, self.layer.P, self.molecule.concentration,
+                                                      self.index))
 
     @property
     def gaussianHW(self):
-        return self.broadenedLine * np.sqrt(2 * k * self.layer.T / self.isotope.molMass / c ** 2)
+        return float(self.isotope.lineTable.gaussianHW(self.layer.T, self.layer.P, self.isotope.molMass,
+                                                       self.index))
 
 
 class Isotope(list):
     def __init__(self, number, molecule):
-        super(Isotope, self).__init__(self)
+        # no argument, list.__init__(self) would iterate the isotope before it has a lineTable
+        super(Isotope, self).__init__()
 
         self.molecule = molecule        
         self.layer = self.molecule.layer
+        self.lineTable = LineTable()
         self.crossSection = np.copy(self.layer.crossSection)
         self.exotic = molecule.exotic
 
@@ -283,10 +556,27 @@ class Isotope(list):
             self.q296 = params[5]
             self.gj = params[6]
             self.molmass = params[7]
-            self.q = {}
+            self.pruneReport = {}
+            self.crossSectionConcentration = None
+            # cached cross section tiles, {tileState: {tile number: samples}}, oldest state first
+            self.tileCache = {}
             self.lineSurvey = np.zeros(int((self.layer.rangeMax - self.layer.rangeMin) / utils.BASE_RESOLUTION))
             self.progressCrossSection = False
 
+    def __len__(self):
+        return len(self.lineTable)
+
+    def __iter__(self):
+        return (Line(self, index) for index in range(len(self.lineTable)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Line(self, i) for i in range(len(self.lineTable))[index]]
+        return Line(self, range(len(self.lineTable))[index])
+
+    def clearLines(self):
+        self.lineTable = LineTable()
+
     @property
     def P(self):
         return self.layer.P
@@ -323,6 +613,11 @@ class Isotope(list):
     def absCoef(self):
         return self.crossSection * self.molecule.concentration * self.layer.P / 1E4 / k / self.layer.T
 
+    @property
+    def column(self):
+        # absorbing molecules per cm2 along the path through the layer
+        return self.molecule.concentration * self.layer.P / 1E4 / k / self.layer.T * self.layer.depth
+
     @property
     def transmittance(self):
         return np.exp(-self.absCoef * self.layer.depth)
@@ -349,81 +644,199 @@ class Isotope(list):
 
     def getData(self):
         print('Getting data for %s, isotope %s' % (self.molecule.name, self.globalIsoNumber))
-        lineDict = utils.gatherData(self.globalIsoNumber, self.layer.effectiveRangeMin, self.layer.effectiveRangeMax)
-        self.q = utils.getQData(self.globalIsoNumber)
-        for line in lineDict:
-            self.append(Line(line, lineDict[line]['intensity'], lineDict[line]['einsteinA'],
-                             lineDict[line]['airHalfWidth'], lineDict[line]['selfHalfWidth'],
-                             lineDict[line]['lowerEnergy'], lineDict[line]['tempExponent'],
-                             lineDict[line]['pressureShift'], self))
+        lineArrays = utils.gatherData(self.globalIsoNumber, self.layer.effectiveRangeMin,
+                                      self.layer.effectiveRangeMax)
+        utils.getQTable(self.globalIsoNumber)
+        self.lineTable = LineTable(**lineArrays)
         self.createLineSurvey()
 
+    def lineArrays(self):
+        # the line table quantities the vectorized cross section engines need, for the current layer
+        layer = self.layer
+        table = self.lineTable
+        concentration = self.molecule.concentration
+        broadenedLine = table.cached('broadenedLine', (layer.P,), lambda: table.broadenedLine(layer.P))
+        gaussianHW = table.cached('gaussianHW', (layer.T, layer.P),
+                                  lambda: table.gaussianHW(layer.T, layer.P, self.molMass))
+        lorentzHW = table.cached('lorentzHW', (layer.T, layer.P, concentration),
+                                 lambda: table.lorentzHW(layer.T, layer.P, concentration))
+        return table.wavenumber, broadenedLine, table.intensity, table.lowerEnergy, gaussianHW, lorentzHW
+
+    def scaledIntensity(self):
+        # line intensities at the layer temperature
+        layer = self.layer
+        table = self.lineTable
+        return table.cached('scaledIntensity', (layer.T, layer.P),
+                            lambda: pyradIntensity.intensityFactor(table.intensity,
+                                                                   table.broadenedLine(layer.P), layer.T,
+                                                                   table.lowerEnergy,
+                                                                   utils.partitionFunction(self.globalIsoNumber,
+                                                                                           layer.T), self.q296))
+
+    def engineInputs(self):
+        # temperature scaled and pruned line arrays with the cutoff of every line, as the engines take them
+        layer = self.layer
+        wavenumber, broadenedLine, intensity, lowerEnergy, gaussianHW, lorentzHW = self.lineArrays()
+        intensity = self.scaledIntensity()
+        if layer.pruneAbsorbance:
+            keep, maxError, strongestPruned = pyradCrossSection.pruneLines(wavenumber, intensity, gaussianHW,
+                                                                         lorentzHW, self.column,
+                                                                         layer.pruneAbsorbance,
+                                                                         layer.distanceFromCenter)
+            print('Pruned %s of %s lines for %s, strongest S * column %.3e cm-1, max absorbance error %.3e'
+                  % (len(keep) - np.sum(keep), len(keep), self.molecule.name, strongestPruned, maxError))
+            self.pruneReport = {'removed': int(len(keep) - np.sum(keep)), 'maxAbsorbanceError': maxError}
+            wavenumber = wavenumber[keep]
+            intensity = intensity[keep]
+            gaussianHW = gaussianHW[keep]
+            lorentzHW = lorentzHW[keep]
+        return wavenumber, intensity, gaussianHW, lorentzHW, layer.lineCutoffs(intensity, gaussianHW, lorentzHW)
+
+    def toXAxis(self, crossSection, gridOffset):
+        # from engine samples starting gridOffset samples past 0 cm-1, see Layer.engineGrid, to the xAxis
+        return interpolateArray(self.xAxis,
+                                pyradCrossSection.gridWavenumbers(gridOffset, len(crossSection), self.resolution),
+                                crossSection)
+
+    def tileState(self, method):
+        # everything other than the spectral range that the tiles of this isotope depend on
+        layer = self.layer
+        state = (method, layer.T, layer.P, self.molecule.concentration, layer.resolution, layer.cutoffThreshold,
+                 layer.relativeCutoff)
+        if layer.pruneAbsorbance:
+            state += (layer.pruneAbsorbance, self.column)
+        return state
+
+    def tiles(self, method):
+        # the cached tiles for the current state keyed by tile number, dropping the least recently used state
+        # once more than TILE_CACHE_STATES are kept
+        state = self.tileState(method)
+        if state in self.tileCache:
+            self.tileCache[state] = self.tileCache.pop(state)
+        else:
+            if len(self.tileCache) >= pyradCrossSection.TILE_CACHE_STATES:
+                del self.tileCache[next(iter(self.tileCache))]
+            self.tileCache[state] = {}
+        return self.tileCache[state]
+
+    def tilesCached(self, method):
+        # True if the layer is tiled and every tile of its range is cached for the current state
+        layer = self.layer
+        if not layer.tileWidth:
+            return False
+        firstTile, tileCount, tileSamples = pyradCrossSection.tileSpan(layer.rangeMin, layer.rangeMax,
+                                                                       layer.resolution, layer.tileWidth)
+        tiles = self.tiles(method)
+        return all(tile in tiles for tile in range(firstTile, firstTile + tileCount))
+
+    def storeTiles(self, tiles, firstTile, grid, tileSamples):
+        for i in range(int(len(grid) / tileSamples)):
+            tiles[firstTile + i] = np.copy(grid[i * tileSamples:(i + 1) * tileSamples])
+
+    def fromTiles(self, tiles, firstTile, tileCount, tileSamples):
+        # assembles the tiles over the layer range onto the xAxis
+        values = np.concatenate([tiles[tile] for tile in range(firstTile, firstTile + tileCount)])
+        return self.toXAxis(values, firstTile * tileSamples)
+
+    def computeTiles(self, method):
+        # computes only the tiles of the layer range that are not cached yet, each run of them in one piece
+        layer = self.layer
+        firstTile, tileCount, tileSamples = pyradCrossSection.tileSpan(layer.rangeMin, layer.rangeMax,
+                                                                       layer.resolution, layer.tileWidth)
+        tiles = self.tiles(method)
+        missing = [tile for tile in range(firstTile, firstTile + tileCount) if tile not in tiles]
+        if missing:
+            print('Processing %s cross section for %s, %s of %s tiles, %s lines'
+                  % (method, self.molecule.name, len(missing), tileCount, len(self)))
+            wavenumber, intensity, gaussianHW, lorentzHW, cutoffs = self.engineInputs()
+            for runStart, runLength in pyradCrossSection.tileRuns(missing):
+                grid = pyradCrossSection.computeCrossSection(method, wavenumber, intensity, gaussianHW, lorentzHW,
+                                                             0, layer.resolution, runLength * tileSamples, cutoffs,
+                                                             gridOffset=runStart * tileSamples)
+                self.storeTiles(tiles, runStart, grid, tileSamples)
+        return self.fromTiles(tiles, firstTile, tileCount, tileSamples)
+
+    def computeCrossSection(self, method):
+        layer = self.layer
+        if layer.tileWidth:
+            return self.computeTiles(method)
+        print('Processing %s cross section for %s, %s lines' % (method, self.molecule.name, len(self)))
+        wavenumber, intensity, gaussianHW, lorentzHW, cutoffs = self.engineInputs()
+        gridOffset, gridLength = layer.engineGrid()
+        crossSection = pyradCrossSection.computeCrossSection(method, wavenumber, intensity, gaussianHW, lorentzHW,
+                                                             0, layer.resolution, gridLength, cutoffs,
+                                                             gridOffset=gridOffset)
+        return self.toXAxis(crossSection, gridOffset)
+
+    def crossSectionTemperatureDerivative(self):
+        # d(cross section) / dT on the xAxis, through the line intensities and both halfwidths, computed on the
+        # same engine grid as the cross section. The cutoffs are held at those of the current cross section, and
+        # pruning is left out. With the default cutoffThreshold, the cutoffs themselves move with T, so the
+        # cross section steps by a sample of wing wherever one crosses a sample. Finite differences over those
+        # steps differ from this derivative; with cutoffThreshold None they agree.
+        layer = self.layer
+        wavenumber, broadenedLine, intensity, lowerEnergy, gaussianHW, lorentzHW = self.lineArrays()
+        intensity = self.scaledIntensity()
+        logQDerivative = np.log(utils.partitionFunction(self.globalIsoNumber, layer.T + 1) /
+                                utils.partitionFunction(self.globalIsoNumber, layer.T - 1)) / 2
+        intensityDerivative = intensity * pyradIntensity.logIntensityDerivative(broadenedLine, layer.T, lowerEnergy,
+                                                                                logQDerivative)
+        print('Processing cross section temperature derivative for %s, %s lines' % (self.molecule.name, len(self)))
+        gridOffset, gridLength = layer.engineGrid()
+        derivative = pyradCrossSection.temperatureDerivative(wavenumber, intensity, intensityDerivative, gaussianHW,
+                                                             gaussianHW / 2 / layer.T, lorentzHW,
+                                                             -self.lineTable.tempExponent * lorentzHW / layer.T,
+                                                             0, layer.resolution, gridLength,
+                                                             layer.lineCutoffs(intensity, gaussianHW, lorentzHW),
+                                                             gridOffset=gridOffset)
+        return self.toXAxis(derivative, gridOffset)
+
+    def absCoefTemperatureDerivative(self):
+        # d(absCoef) / dT at the layer pressure, where the number density falls as 1 / T
+        return ((self.crossSectionTemperatureDerivative() - getCrossSection(self) / self.layer.T)
+                * self.molecule.concentration * self.layer.P / 1E4 / k / self.layer.T)
+
+    def lookupCrossSection(self):
+        # the cross section interpolated from a loaded lookup table, or None if none covers the layer. Only
+        # tables with the layer's method and cutoffs are used, and of those built at another concentration only
+        # the ones whose self broadening moves no lorentz width by more than CONCENTRATION_WIDTH_TOLERANCE.
+        layer = self.layer
+        tables = [table for table in pyradLookup.matchingTables(self.globalIsoNumber, layer.crossSectionMethod,
+                                                                layer.cutoffThreshold, layer.relativeCutoff)
+                  if self.widthChange(table['concentration']) <= CONCENTRATION_WIDTH_TOLERANCE]
+        return pyradLookup.lookupCrossSection(tables, layer.T, layer.P, self.xAxis)
+
     def createCrossSection(self):
-        molecule = self.molecule
-        layer = molecule.layer
-        progress = 0
-        i = 1
-        alertInterval = int(len(self) / 20)
-        crossSection = np.copy(self.yAxis)
-        trackGauss = 0
-        trackLorentz = 0
-        trackVoigt = 0
-        for line in self:
-            if progress > i * alertInterval:
-                print('Progress for %s <%s%s>' % (molecule.name, '*' * i, '-' * (20 - i)), end='\r')
-                os.sys.stdout.flush()
-                i += 1
-            progress += 1
-            xValues = np.arange(0, layer.distanceFromCenter, layer.resolution)
-            hwRatio = line.lorentzHW / line.gaussianHW
-            if hwRatio < .01:
-                rightCurve = ls.gaussianLineShape(line.gaussianHW, xValues)
-                trackGauss += 1
-            elif hwRatio > 100:
-                rightCurve = ls.lorentzLineShape(line.lorentzHW, xValues)
-                trackLorentz += 1
-            else:
-                rightCurve = ls.pseudoVoigtShape(line.gaussianHW, line.lorentzHW, xValues)
-                trackVoigt += 1
-            intensity = pyradIntensity.intensityFactor(line.intensity, line.broadenedLine,
-                                                       layer.T, line.lowerEnergy, self.q[layer.T], self.q296)
-            arrayIndex = int((line.wavenumber - layer.rangeMin) / layer.resolution)
-            arrayLength = len(crossSection) - 1
-            if isBetween(arrayIndex, 0, arrayLength):
-                crossSection[arrayIndex] = crossSection[arrayIndex] + rightCurve[0] * intensity
-            for dx in range(1, len(rightCurve) - 1):
-                rightIndex = arrayIndex + dx
-                leftIndex = arrayIndex - dx
-                if isBetween(rightIndex, 0, arrayLength):
-                    crossSection[rightIndex] += rightCurve[dx] * intensity
-                if isBetween(leftIndex, 0, arrayLength):
-                    crossSection[leftIndex] += rightCurve[dx] * intensity
-        self.crossSection = interpolateArray(self.xAxis,
-                                             np.linspace(self.rangeMin, self.rangeMax,
-                                                         (self.rangeMax - self.rangeMin) / self.resolution,
-                                                         endpoint=True),
-                                             crossSection)
-        print('\ngaussian only: %s\t lorentz only: %s\t voigt: %s\n' % (trackGauss, trackLorentz, trackVoigt), end='\r')
+        crossSection = self.lookupCrossSection()
+        if crossSection is None:
+            crossSection = self.computeCrossSection(self.layer.crossSectionMethod)
+        self.crossSection = crossSection
         self.progressCrossSection = True
+        self.crossSectionConcentration = self.molecule.concentration
+
+    def widthChange(self, concentration=None):
+        # largest relative change of a lorentz width between concentration, by default the one the cross section
+        # was computed for, and the current one. Temperature and pressure scale both widths alike and drop out.
+        if concentration is None:
+            concentration = self.crossSectionConcentration
+        if concentration is None:
+            return np.inf
+        table = self.lineTable
+        oldWidth = table.lorentzHW(t0, p0, concentration)
+        newWidth = table.lorentzHW(t0, p0, self.molecule.concentration)
+        change = np.abs(newWidth - oldWidth) / np.maximum(oldWidth, np.finfo(float).tiny)
+        if len(change) == 0:
+            return 0
+        return np.max(change)
 
     def createLineSurvey(self):
         print('Creating line survey for %s' % self.name)
-        molecule = self.molecule
-        layer = molecule.layer
-        progress = 0
-        i = 1
-        alertInterval = int(len(self) / 20)
+        layer = self.layer
         lineSurvey = np.zeros(int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION))
-        for line in self:
-            if progress > i * alertInterval:
-                print('Progress for %s <%s%s>' % (molecule.name, '*' * i, '-' * (20 - i)), end='\r', flush=True)
-                i += 1
-            progress += 1
-            intensity = line.intensity
-            arrayIndex = int((line.wavenumber - layer.rangeMin) / layer.resolution)
-            arrayLength = len(lineSurvey) - 1
-            if isBetween(arrayIndex, 0, arrayLength):
-                lineSurvey[arrayIndex] = lineSurvey[arrayIndex] + intensity
+        arrayIndex = np.trunc((self.lineTable.wavenumber - layer.rangeMin) / layer.resolution).astype(int)
+        inSurvey = (arrayIndex >= 0) & (arrayIndex < len(lineSurvey))
+        lineSurvey += np.bincount(arrayIndex[inSurvey], weights=self.lineTable.intensity[inSurvey],
+                                  minlength=len(lineSurvey))
         self.lineSurvey = lineSurvey
         return self.lineSurvey
 
@@ -543,26 +956,49 @@ class Molecule(list):
     def setPercentage(self, percentage):
         self.concentration = percentage / 100
         self.concText = '%s %%' % percentage
-        resetCrossSection(self)
+        self.concentrationChanged()
 
     def setPPM(self, ppm):
         self.concentration = ppm * 10**-6
         self.concText = '%s ppm' % ppm
-        resetCrossSection(self)
+        self.concentrationChanged()
 
     def setPPB(self, ppb):
         self.concentration = ppb * 10**-8
         self.concText = '%s ppb' % ppb
-        resetCrossSection(self)
+        self.concentrationChanged()
 
     def setConcentration(self, concentration):
         self.setPPM(concentration * 1E6)
-        resetCrossSection(self)
+
+    def concentrationChanged(self):
+        # absCoef already scales with the concentration, so a cross section only goes stale through self
+        # broadening. Isotopes whose lorentz widths moved by less than CONCENTRATION_WIDTH_TOLERANCE keep theirs,
+        # unless the layer prunes lines, which depends on the column amount.
+        recompute = False
+        for isotope in self:
+            if isotope.exotic or not isotope.progressCrossSection:
+                continue
+            if self.layer.pruneAbsorbance or isotope.widthChange() > CONCENTRATION_WIDTH_TOLERANCE:
+                resetCrossSection(isotope)
+                recompute = True
+        if recompute:
+            self.progressCrossSection = False
+            self.layer.progressCrossSection = False
 
     def getData(self):
         for isotope in self:
             isotope.getData()
 
+    def absCoefTemperatureDerivative(self):
+        # d(absCoef) / dT. Cross sections read from xsc files don't change with T, only the number density does.
+        if self.exotic:
+            return -getAbsCoef(self) / self.layer.T
+        tempAxis = np.zeros(int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION))
+        for isotope in self:
+            tempAxis += isotope.absCoefTemperatureDerivative()
+        return tempAxis
+
     def createCrossSection(self):
         tempAxis = np.zeros(int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION))
         for isotope in self:
@@ -645,21 +1081,34 @@ class Molecule(list):
 class Layer(list):
     hasAtmosphere = False
 
-    def __init__(self, depth, T, P, rangeMin, rangeMax, atmosphere=None, name='', dynamicResolution=True):
+    def __init__(self, depth, T, P, rangeMin, rangeMax, atmosphere=None, name='', dynamicResolution=True,
+                 crossSectionMethod='direct', cutoffThreshold=pyradCrossSection.CUTOFF_THRESHOLD, relativeCutoff=True,
+                 pruneAbsorbance=None, workers=None, tileWidth=pyradCrossSection.TILE_WIDTH):
         super(Layer, self).__init__(self)
+        self.crossSectionMethod = crossSectionMethod
+        # cross sections are computed and cached in tiles this many cm-1 wide, so a new range only computes
+        # the tiles it has not seen. None computes the layer range in one piece.
+        self.tileWidth = tileWidth
+        # processes the isotopes and spectral chunks are spread over. None or 1 runs serially.
+        self.workers = workers
+        # weak lines are left out of each isotope as long as they could change the absorbance through the whole
+        # layer depth by no more than pruneAbsorbance. None keeps every line.
+        self.pruneAbsorbance = pruneAbsorbance
+        # lines are cut off where their wing drops under cutoffThreshold, a fraction of the strongest line peak
+        # if relativeCutoff, otherwise a cross section. None cuts every line off at distanceFromCenter.
+        self.cutoffThreshold = cutoffThreshold
+        self.relativeCutoff = relativeCutoff
         self.rangeMin = rangeMin
         self.rangeMax = rangeMax
         self.T = T
         self.P = P
         self.depth = depth
-        self.distanceFromCenter = self.P / 1013.25 * 5
-        self.effectiveRangeMin = max(self.rangeMin - self.distanceFromCenter, 0)
-        self.effectiveRangeMax = self.rangeMax + self.distanceFromCenter
         self.dynamicResolution = dynamicResolution
         if not dynamicResolution:
             self.resolution = utils.BASE_RESOLUTION
         else:
             self.resolution = max(10**int(np.log10((self.P / 1013.25))) * .01, utils.BASE_RESOLUTION)
+        self.updateCutoff()
         if not atmosphere:
             if not Layer.hasAtmosphere:
                 self.atmosphere = Atmosphere('generic')
@@ -682,6 +1131,8 @@ class Layer(list):
         return True
 
     def createCrossSection(self):
+        if self.workers and self.workers > 1:
+            createCrossSectionsParallel(self)
         tempAxis = np.zeros(int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION))
         for molecule in self:
             tempAxis += getCrossSection(molecule)
@@ -701,7 +1152,7 @@ class Layer(list):
 
     @property
     def xAxis(self):
-        return np.linspace(self.rangeMin, self.rangeMax, (self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION,
+        return np.linspace(self.rangeMin, self.rangeMax, int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION),
                            endpoint=True)
 
     @property
@@ -731,42 +1182,112 @@ class Layer(list):
     def emittance(self):
         return self.emissivity
 
+    def updateCutoff(self):
+        # distanceFromCenter is the widest cutoff the policy can give any line, and sets the margins of the line
+        # data. Returns True if the margins now reach past the lines already loaded, which then have to be
+        # reloaded. Lines loaded for wider margins are kept when the margins shrink.
+        # with tiles, the margins are taken from the outer edges of the first and last tile
+        self.distanceFromCenter = pyradCrossSection.maximumCutoff(self.P, self.T, self.rangeMax)
+        rangeMin, rangeMax = self.rangeMin, self.rangeMax
+        if self.tileWidth:
+            firstTile, tileCount, tileSamples = pyradCrossSection.tileSpan(self.rangeMin, self.rangeMax,
+                                                                           self.resolution, self.tileWidth)
+            rangeMin = firstTile * tileSamples * self.resolution
+            rangeMax = (firstTile + tileCount) * tileSamples * self.resolution
+        self.effectiveRangeMin = max(rangeMin - self.distanceFromCenter, 0)
+        self.effectiveRangeMax = rangeMax + self.distanceFromCenter
+        if hasattr(self, 'loadedRangeMin') and self.loadedRangeMin <= self.effectiveRangeMin \
+                and self.effectiveRangeMax <= self.loadedRangeMax:
+            return False
+        self.loadedRangeMin = self.effectiveRangeMin
+        self.loadedRangeMax = self.effectiveRangeMax
+        return True
+
+    def engineGrid(self):
+        # the samples the engines compute for the layer range, on the grid that starts at 0 cm-1 and steps by
+        # the resolution, as (gridOffset, gridLength): whole tiles with tiles, otherwise the range itself. Every
+        # path maps sample i of it to (gridOffset + i) * resolution, so tiled and untiled cross sections agree.
+        if self.tileWidth:
+            firstTile, tileCount, tileSamples = pyradCrossSection.tileSpan(self.rangeMin, self.rangeMax,
+                                                                           self.resolution, self.tileWidth)
+            return firstTile * tileSamples, tileCount * tileSamples
+        return pyradCrossSection.gridSpan(self.rangeMin, self.rangeMax, self.resolution)
+
+    def lineCutoffs(self, intensities, gaussianHW, lorentzHW):
+        # cutoff of every line in cm-1 from the temperature scaled intensities and halfwidths
+        if self.cutoffThreshold is None:
+            return self.distanceFromCenter
+        return pyradCrossSection.lineCutoffs(intensities, gaussianHW, lorentzHW, self.cutoffThreshold,
+                                             self.relativeCutoff, self.distanceFromCenter)
+
+    def changeCutoff(self, cutoffThreshold, relativeCutoff=None):
+        # relativeCutoff None keeps the kind of threshold the layer has
+        self.cutoffThreshold = cutoffThreshold
+        if relativeCutoff is not None:
+            self.relativeCutoff = relativeCutoff
+        resetCrossSection(self)
+
     def changeRange(self, rangeMin, rangeMax):
         self.rangeMin = rangeMin
         self.rangeMax = rangeMax
-        self.effectiveRangeMax = self.rangeMax + self.distanceFromCenter
-        self.effectiveRangeMin = max(self.rangeMin - self.distanceFromCenter, 0)
-        resetData(self)
+        if self.updateCutoff():
+            resetData(self)
+        else:
+            resetCrossSection(self)
+            resetLineSurvey(self)
 
     def changeTemperature(self, temperature):
         self.T = temperature
-        resetCrossSection(self)
+        if self.updateCutoff():
+            resetData(self)
+        else:
+            resetCrossSection(self)
 
     def changePressure(self, pressure):
         self.P = pressure
-        self.distanceFromCenter = self.P / 1013.25 * 5
         if not self.dynamicResolution:
             self.resolution = utils.BASE_RESOLUTION
         else:
             self.resolution = max(10**int(np.log10((self.P / 1013.25))) * .01, utils.BASE_RESOLUTION)
-        resetData(self)
+        if self.updateCutoff():
+            resetData(self)
+        else:
+            resetCrossSection(self)
+            resetLineSurvey(self)
 
     def changeDepth(self, depth):
         self.depth = depth
+        if self.pruneAbsorbance:
+            resetCrossSection(self)
+
+    def changePruning(self, pruneAbsorbance):
+        self.pruneAbsorbance = pruneAbsorbance
+        resetCrossSection(self)
+
+    def changeWorkers(self, workers):
+        self.workers = workers
 
-    def addMolecule(self, name, isotopeDepth=1, **abundance):
+    def changeCrossSectionMethod(self, crossSectionMethod):
+        self.crossSectionMethod = crossSectionMethod
+        resetCrossSection(self)
+
+    def addMolecule(self, name, isotopeDepth=1, loadData=True, **abundance):
+        # with loadData False the lines are left for the caller to load, as buildAtmosphere does for every layer
         molecule = Molecule(name, self, isotopeDepth, **abundance)
 
         self.append(molecule)
         if totalConcentration(self) > 1:
             print('**Warning : Concentrations exceed 1.')
-        if not molecule.exotic:
+        if not molecule.exotic and loadData:
             molecule.getData()
         return molecule
 
     def returnCopy(self):
         newCopy = Layer(self.depth, self.T, self.P, self.rangeMin, self.rangeMax,
-                        self.atmosphere, name=self.atmosphere.nextLayerName(), dynamicResolution=self.dynamicResolution)
+                        self.atmosphere, name=self.atmosphere.nextLayerName(), dynamicResolution=self.dynamicResolution,
+                        crossSectionMethod=self.crossSectionMethod, cutoffThreshold=self.cutoffThreshold,
+                        relativeCutoff=self.relativeCutoff, pruneAbsorbance=self.pruneAbsorbance,
+                        workers=self.workers, tileWidth=self.tileWidth)
         for molecule in self:
             newMolecule = molecule.returnCopy()
             newCopy.append(newMolecule)
@@ -786,6 +1307,83 @@ class Layer(list):
         emitted = self.emittance * self.planck(self.T)
         return transmitted + emitted
 
+    def absCoefTemperatureDerivative(self):
+        tempAxis = np.zeros(int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION))
+        for molecule in self:
+            tempAxis += molecule.absCoefTemperatureDerivative()
+        return tempAxis
+
+    def depthSweep(self, depths):
+        # transmittance, absorbance and emissivity through every path length in depths (cm), depths x wavenumbers,
+        # from the one cross section of the layer. Lines pruned for the layer depth may matter on longer paths.
+        depths = np.atleast_1d(np.asarray(depths, dtype=float))
+        opticalDepth = depths[:, np.newaxis] * getAbsCoef(self)
+        return {'depth': depths,
+                'transmittance': np.exp(-opticalDepth),
+                'absorbance': opticalDepth / np.log(10),
+                'emissivity': -np.expm1(-opticalDepth)}
+
+    def concentrationSweep(self, concentrations, depths=None, surfaceTemperature=None, bandEdges=None):
+        # transmittance and absorbance for a sweep of concentrations, {molecule name: concentrations}, whose
+        # arrays broadcast together to one sweep axis. Molecules left out keep their concentration. absCoef is
+        # linear in concentration, so every step reuses the current cross sections; self broadening stays at
+        # the current concentrations. Results are sweep x wavenumbers, or sweep x depths x wavenumbers for an
+        # array of depths (cm). With surfaceTemperature, 'bandPower' (W/m2) is the power leaving the layer
+        # above that surface, as integrateSpectrum of transmission, in each band between bandEdges (cm-1) or
+        # over the whole range.
+        names = [molecule.name for molecule in self]
+        missing = [name for name in concentrations if name not in names]
+        if missing:
+            print('%s has no %s' % (self.name, ', '.join(missing)))
+            return False
+        steps = np.broadcast_arrays(*[np.atleast_1d(np.asarray(values, dtype=float))
+                                      for values in concentrations.values()])
+        absCoef = np.zeros((len(steps[0]), int((self.rangeMax - self.rangeMin) / utils.BASE_RESOLUTION)))
+        density = self.P / 1E4 / k / self.T
+        for molecule in self:
+            if molecule.name in concentrations:
+                sweep = steps[list(concentrations).index(molecule.name)]
+                absCoef += sweep[:, np.newaxis] * getCrossSection(molecule) * density
+            else:
+                absCoef += getAbsCoef(molecule)
+        if depths is None:
+            opticalDepth = absCoef * self.depth
+        else:
+            opticalDepth = absCoef[:, np.newaxis, :] * np.asarray(depths, dtype=float)[:, np.newaxis]
+        results = {'transmittance': np.exp(-opticalDepth),
+                   'absorbance': opticalDepth / np.log(10)}
+        if surfaceTemperature is not None:
+            spectrum = results['transmittance'] * self.planck(surfaceTemperature) + \
+                -np.expm1(-opticalDepth) * self.planck(self.T)
+            xAxis = self.xAxis[:spectrum.shape[-1]]
+            if bandEdges is None:
+                bandEdges = (self.rangeMin, self.rangeMax + utils.BASE_RESOLUTION)
+            results['bandPower'] = np.stack([np.sum(np.nan_to_num(spectrum[..., (xAxis >= low) & (xAxis < high)]),
+                                                    axis=-1) * pi * utils.BASE_RESOLUTION
+                                             for low, high in zip(bandEdges[:-1], bandEdges[1:])], axis=-1)
+        return results
+
+    def kDistribution(self, bandEdges, gPoints=pyradKDistribution.G_POINTS):
+        # correlated-k distribution of the layer absorption coefficient in each band between bandEdges (cm-1)
+        absCoef = self.absCoef
+        return pyradKDistribution.kDistribution(self.xAxis[:len(absCoef)], absCoef, bandEdges, gPoints)
+
+    def bandPower(self, bandEdges, surfaceTemperature, gPoints=pyradKDistribution.G_POINTS, compare=False):
+        # band power (W/m2) leaving the layer above a surface at surfaceTemperature, from the k distribution.
+        # With compare, also returns the line by line band power of the full spectrum, which costs the whole
+        # transmission spectrum.
+        kDist = self.kDistribution(bandEdges, gPoints)
+        centers = (kDist['bandEdges'][1:] + kDist['bandEdges'][:-1]) / 2
+        kPower = pyradKDistribution.bandPower(kDist, self.depth, pyradPlanck.planckWavenumber(centers, surfaceTemperature),
+                                              pyradPlanck.planckWavenumber(centers, self.T))
+        if not compare:
+            return kPower
+        spectrum = self.transmission(self.planck(surfaceTemperature))
+        xAxis = self.xAxis[:len(spectrum)]
+        lblPower = np.array([integrateSpectrum(spectrum[(xAxis >= low) & (xAxis < high)])
+                             for low, high in zip(bandEdges[:-1], bandEdges[1:])])
+        return kPower, lblPower
+
 
 class Atmosphere(list):
     def __init__(self, name):
@@ -798,16 +1396,95 @@ class Atmosphere(list):
     def __bool__(self):
         return True
 
-    def addLayer(self, depth, T, P, rangeMin, rangeMax, name=None, dynamicResolution=True):
+    def addLayer(self, depth, T, P, rangeMin, rangeMax, name=None, dynamicResolution=True, crossSectionMethod='direct',
+                 cutoffThreshold=pyradCrossSection.CUTOFF_THRESHOLD, relativeCutoff=True, pruneAbsorbance=None,
+                 workers=None, tileWidth=pyradCrossSection.TILE_WIDTH):
         if not name:
             name = self.nextLayerName()
-        newLayer = Layer(depth, T, P, rangeMin, rangeMax, atmosphere=self, name=name, dynamicResolution=dynamicResolution)
+        newLayer = Layer(depth, T, P, rangeMin, rangeMax, atmosphere=self, name=name, dynamicResolution=dynamicResolution,
+                         crossSectionMethod=crossSectionMethod, cutoffThreshold=cutoffThreshold,
+                         relativeCutoff=relativeCutoff, pruneAbsorbance=pruneAbsorbance, workers=workers,
+                         tileWidth=tileWidth)
         self.append(newLayer)
         return newLayer
 
     def nextLayerName(self):
         return 'Layer %s' % (len(self) + 1)
 
+    def createCrossSections(self, batched=True):
+        # cross sections of every layer, computing the layers that share a grid together if batched
+        if batched:
+            createCrossSectionsBatched(self)
+        for layer in self:
+            if not layer.progressCrossSection:
+                layer.createCrossSection()
+
+    def opticalDepths(self):
+        # layers x wavenumbers optical depths, in the order the layers were added, surface first
+        self.createCrossSections()
+        return np.array([getAbsCoef(layer) * layer.depth for layer in self])
+
+    def transferInputs(self, surfaceTemperature):
+        # the layers x wavenumbers optical depths and planck radiances of the layers, surface first, and the
+        # surface planck radiance, or False if the layers can't be stacked
+        if not self:
+            print('%s has no layers' % self.name)
+            return False
+        if len(set((layer.rangeMin, layer.rangeMax) for layer in self)) > 1:
+            print('Every layer of %s needs the same range to solve the radiative transfer' % self.name)
+            return False
+        opticalDepths = self.opticalDepths()
+        xAxis = self[0].xAxis[:opticalDepths.shape[1]]
+        temperatures = np.array([[layer.T] for layer in self])
+        return (opticalDepths, pyradPlanck.planckWavenumber(xAxis, temperatures),
+                pyradPlanck.planckWavenumber(xAxis, surfaceTemperature))
+
+    def solveTransfer(self, surfaceTemperature, surfaceEmissivity=1, zenithAngle=0):
+        # upwelling and downwelling radiance at every layer boundary, top of atmosphere radiance, surface
+        # downwelling radiance and level fluxes along a path zenithAngle degrees from vertical, see
+        # pyradTransfer.solveTransfer. Layers are stacked in the order they were added, starting at the surface,
+        # and have to share one range.
+        inputs = self.transferInputs(surfaceTemperature)
+        if not inputs:
+            return False
+        return pyradTransfer.solveTransfer(*inputs, surfaceEmissivity=surfaceEmissivity, res=utils.BASE_RESOLUTION,
+                                           mu=np.cos(np.radians(zenithAngle)))
+
+    def jacobians(self, surfaceTemperature, surfaceEmissivity=1, zenithAngle=0):
+        # solveTransfer at zenithAngle with the derivatives of the top of atmosphere radiance by the temperature
+        # of every layer, 'temperature' (layers x wavenumbers), and by the concentration (mixing ratio) of every
+        # molecule in every layer, 'concentration', {molecule name: layers x wavenumbers}. Self broadening is
+        # left out of the concentration derivatives. Costs one forward pass plus one derivative cross section
+        # per isotope and layer, rather than a full run per perturbed layer. The temperature derivatives hold
+        # the line cutoffs fixed, see Isotope.crossSectionTemperatureDerivative: with cutoffs that move with T,
+        # finite differences of a kelvin or so can differ from them by percents at the few wavenumbers where a
+        # cutoff steps. Build the layers with cutoffThreshold None to compare the two.
+        inputs = self.transferInputs(surfaceTemperature)
+        if not inputs:
+            return False
+        mu = np.cos(np.radians(zenithAngle))
+        results = pyradTransfer.toaJacobians(*inputs, surfaceEmissivity=surfaceEmissivity, mu=mu)
+        xAxis = self[0].xAxis[:inputs[0].shape[1]]
+        temperatures = np.array([[layer.T] for layer in self])
+        opticalDepthDerivatives = np.array([layer.absCoefTemperatureDerivative() * layer.depth for layer in self])
+        results['temperature'] = results['byOpticalDepth'] * opticalDepthDerivatives + \
+            results['byLayerRadiance'] * pyradPlanck.planckTemperatureDerivative(xAxis, temperatures)
+        results['concentration'] = {}
+        for i, layer in enumerate(self):
+            for molecule in layer:
+                derivative = results['concentration'].setdefault(molecule.name, np.zeros(inputs[0].shape))
+                derivative[i] = results['byOpticalDepth'][i] * getCrossSection(molecule) * layer.P / 1E4 / k / \
+                    layer.T * layer.depth
+        return results
+
+    def angularFluxes(self, surfaceTemperature, surfaceEmissivity=1, angles=pyradTransfer.FLUX_ANGLES):
+        # level fluxes integrated over angles zenith angles, see pyradTransfer.angularFluxes
+        inputs = self.transferInputs(surfaceTemperature)
+        if not inputs:
+            return False
+        return pyradTransfer.angularFluxes(*inputs, surfaceEmissivity=surfaceEmissivity, res=utils.BASE_RESOLUTION,
+                                           angles=angles)
+
     def returnLayerNames(self):
         tempList = []
         for layer in self:
@@ -873,6 +1550,28 @@ def plot(propertyToPlot, title, plotList, fill=False):
     plt.show()
 
 
+def plotDepths(layer, propertyToPlot, depths):
+    # overlays propertyToPlot, transmittance, absorbance or emissivity, of layer over several path lengths (cm)
+    sweep = layer.depthSweep(depths)
+    plt.figure(figsize=(10, 6), dpi=80)
+    plt.subplot(111, facecolor='xkcd:dark grey')
+    plt.xlabel('wavenumber cm-1')
+    plt.margins(0.01)
+    plt.subplots_adjust(left=.07, bottom=.08, right=.97, top=.90)
+    plt.ylabel(propertyToPlot)
+    plt.grid('grey', linewidth=.5, linestyle=':')
+    plt.title('%s\nP: %smBars; T: %sK' % (str(layer), layer.P, layer.T))
+    handles = []
+    xAxis = layer.xAxis[:sweep[propertyToPlot].shape[1]]
+    for depth, yAxis, color in zip(sweep['depth'], sweep[propertyToPlot], COLOR_LIST):
+        fig, = plt.plot(xAxis, yAxis, linewidth=.7, alpha=.7, color=color, label='%scm' % depth)
+        handles.append(fig)
+    legend = plt.legend(handles=handles, frameon=False)
+    text = legend.get_texts()
+    plt.setp(text, color='w')
+    plt.show()
+
+
 def plotSpectrum(layer=None, title=None, rangeMin=None, rangeMax=None, objList=None, surfaceSpectrum=None,
                  planckTemperatureList=None, planckType='wavenumber', fill=False):
     plt.figure(figsize=(10, 6), dpi=80)
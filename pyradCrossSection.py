@@ -0,0 +1,478 @@
+import concurrent.futures
+import multiprocessing
+import numpy as np
+import pyradLineshape as ls
+
+#   the number of line x offset samples evaluated at once. Small enough that a block's temporaries stay in cache.
+BLOCK_SAMPLES = 2**16
+#   halfwidth classes per axis (gaussian and lorentz) for the fft method. 4 keeps the error near .3% of the peak.
+FFT_HALFWIDTH_CLASSES = 4
+#   fine samples per coarse sample for the two grid method, and the core halfwidth in coarse samples.
+#   the wing has to be smooth over a few coarse samples for the interpolation back onto the fine grid.
+TWO_GRID_FACTOR = 20
+TWO_GRID_CORE_STEPS = 4
+#   line cutoff policy. The fixed cutoff is CUTOFF_DISTANCE cm-1 at 1 atm and bounds every adaptive cutoff.
+#   each line reaches out until its wing drops below the threshold, but never less than CUTOFF_MIN_HALFWIDTHS
+#   voigt halfwidths, so weak lines keep their core and low pressure lines are never cut inside the doppler width.
+#   the relative threshold is a fraction of the strongest line peak in the isotope.
+CUTOFF_DISTANCE = 5
+CUTOFF_MIN_HALFWIDTHS = 4
+CUTOFF_THRESHOLD = 1E-6
+#   bins per cutoff distance for the pruning error bound. More bins give a tighter bound for more work.
+PRUNE_BIN_STEPS = 8
+#   spectral chunks per worker for the parallel method, enough to keep every worker busy to the end.
+#   chunks are a multiple of PARALLEL_CHUNK_MULTIPLE samples, which TWO_GRID_FACTOR has to divide.
+PARALLEL_CHUNKS_PER_WORKER = 4
+PARALLEL_CHUNK_MULTIPLE = 100
+#   width in cm-1 of the spectral tiles cross sections are cached in, and how many (T, P, broadening) states
+#   of tiles an isotope keeps before dropping the oldest
+TILE_WIDTH = 10
+TILE_CACHE_STATES = 4
+#   lightest molecule mass (H2) in kg, bounds the doppler width of any line when no line list is at hand
+CUTOFF_LIGHTEST_MASS = 2.016 / 1000 / 6.022140857E23
+
+
+def scatterAdd(grid, centerIndex, offsets, values):
+    # adds values[line, dx] into grid[centerIndex[line] + offsets[dx]] for every line in the block.
+    # samples that land outside of the grid are clipped off rather than wrapped.
+    indices = centerIndex[:, np.newaxis] + offsets[np.newaxis, :]
+    low = max(centerIndex.min() + offsets[0], 0)
+    high = min(centerIndex.max() + offsets[-1] + 1, len(grid))
+    if high <= low:
+        return grid
+    indices -= low
+    if low > centerIndex.min() + offsets[0] or high < centerIndex.max() + offsets[-1] + 1:
+        valid = (indices >= 0) & (indices < high - low)
+        indices = indices[valid]
+        values = values[valid]
+    grid[low:high] += np.bincount(indices.ravel(), weights=values.ravel(), minlength=high - low)
+    return grid
+
+
+def maximumCutoff(P, T, rangeMax):
+    #   the largest cutoff the policy can give any line in a layer, used for the margins of the line data.
+    #   the fixed cutoff, widened at low pressure to cover the doppler core of the lightest molecule.
+    dopplerHW = ls.voigtHW(ls.gaussianHW(rangeMax + P / ls.p0 * CUTOFF_DISTANCE, T, CUTOFF_LIGHTEST_MASS), 0)
+    return max(P / ls.p0 * CUTOFF_DISTANCE, CUTOFF_MIN_HALFWIDTHS * dopplerHW)
+
+
+def lineCutoffs(intensities, gaussianHW, lorentzHW, threshold, relative, maximum):
+    #   per line cutoff in cm-1: where the lorentz wing S lHW / (pi x^2) or the gaussian S / (gHW sqrt(pi))
+    #   exp(-x^2 / gHW^2) falls below threshold, kept between CUTOFF_MIN_HALFWIDTHS voigt halfwidths and maximum.
+    #   intensities are the temperature scaled line intensities, threshold is in cross section units
+    #   (cm2/molecule / cm-1) or, if relative, a fraction of the strongest line peak.
+    intensities = np.asarray(intensities, dtype=float)
+    gaussianHW = np.asarray(gaussianHW, dtype=float)
+    lorentzHW = np.asarray(lorentzHW, dtype=float)
+    if len(intensities) == 0:
+        return np.zeros(0)
+    if relative:
+        threshold = threshold * np.max(intensities * ls.voigtTableShape(gaussianHW, lorentzHW, [0])[:, 0])
+    if threshold <= 0:
+        return np.full(len(intensities), float(maximum))
+    lorentzDistance = np.sqrt(intensities * lorentzHW / ls.pi / threshold)
+    gaussianPeak = intensities / gaussianHW / np.sqrt(ls.pi)
+    gaussianDistance = gaussianHW * np.sqrt(np.log(np.maximum(gaussianPeak / threshold, 1)))
+    cutoff = np.maximum(lorentzDistance, gaussianDistance)
+    cutoff = np.maximum(cutoff, CUTOFF_MIN_HALFWIDTHS * ls.voigtHW(gaussianHW, lorentzHW))
+    return np.minimum(cutoff, maximum)
+
+
+def pruneBound(bins, binDepth, dropped):
+    #   the largest optical depth the dropped lines could add anywhere. binDepth[line, k] bounds what a line
+    #   adds k bins away from its own, so summing the dropped lines per bin and spreading each sum k bins both
+    #   ways bounds every bin.
+    binCount = np.max(bins) + 1
+    bound = np.zeros(binCount + 2 * binDepth.shape[1])
+    for step in range(binDepth.shape[1]):
+        binSum = np.bincount(bins[dropped], weights=binDepth[dropped, step], minlength=binCount)
+        bound[binDepth.shape[1] + step:binDepth.shape[1] + step + binCount] += binSum
+        if step:
+            bound[binDepth.shape[1] - step:binDepth.shape[1] - step + binCount] += binSum
+    return np.max(bound)
+
+
+def pruneLines(wavenumbers, intensities, gaussianHW, lorentzHW, column, maxAbsorbance, distanceFromCenter):
+    #   drops the lines with the smallest strength times column (integrated optical depth, cm-1) for as long as
+    #   the absorbance they could add at any one wavenumber stays under maxAbsorbance. The spectrum is split
+    #   into PRUNE_BIN_STEPS bins per cutoff distance, and a line k bins away adds at most its profile at the
+    #   near edge of that bin, so the bound holds however the dropped lines fall. column is in molecules / cm2.
+    #   returns the mask of lines kept, the worst case absorbance error and the strength times column of the
+    #   strongest line dropped.
+    intensities = np.asarray(intensities, dtype=float)
+    keep = np.ones(len(intensities), dtype=bool)
+    if len(intensities) == 0 or not maxAbsorbance:
+        return keep, 0, 0
+    binWidth = distanceFromCenter / PRUNE_BIN_STEPS
+    wavenumbers = np.asarray(wavenumbers, dtype=float)
+    bins = np.floor((wavenumbers - np.min(wavenumbers)) / binWidth).astype(int)
+    edgeDistance = np.maximum(np.arange(PRUNE_BIN_STEPS + 2) - 1, 0) * binWidth
+    binDepth = ls.voigtTableShape(gaussianHW, lorentzHW, edgeDistance) * (intensities * column)[:, np.newaxis]
+    order = np.argsort(intensities)
+    maxDepth = maxAbsorbance * np.log(10)
+    low = 0
+    high = len(order)
+    while low < high:
+        middle = int((low + high + 1) / 2)
+        if pruneBound(bins, binDepth, order[:middle]) <= maxDepth:
+            low = middle
+        else:
+            high = middle - 1
+    if low == 0:
+        return keep, 0, 0
+    keep[order[:low]] = False
+    return keep, pruneBound(bins, binDepth, order[:low]) / np.log(10), intensities[order[low - 1]] * column
+
+
+def cutoffSamples(distanceFromCenter, resolution, lineCount):
+    #   samples in the right half of each line, matching len(np.arange(0, distanceFromCenter, resolution)[:-1]).
+    #   distanceFromCenter is a single cutoff for every line or one per line.
+    samples = np.ceil(np.broadcast_to(np.asarray(distanceFromCenter, dtype=float), (lineCount,)) / resolution)
+    return np.maximum(samples.astype(int) - 1, 0)
+
+
+def widthBlocks(widths):
+    #   yields blocks of line indices along with the widest line in the block. Lines are grouped by width
+    #   within a factor of 2 and keep their order inside a group, so the lines of a block stay close together
+    #   on the grid. Blocks are sized so that the lines by twice their width hold about BLOCK_SAMPLES values.
+    widthClass = np.ceil(np.log2(np.maximum(widths, 1))).astype(int)
+    widthClass[widths < 1] = -1
+    order = np.argsort(widthClass, kind='stable')
+    sortedClass = widthClass[order]
+    start = np.searchsorted(sortedClass, 0)
+    while start < len(order):
+        end = np.searchsorted(sortedClass, sortedClass[start], 'right')
+        count = max(int(BLOCK_SAMPLES / 2**(sortedClass[start] + 1)), 1)
+        for blockStart in range(start, end, count):
+            block = order[blockStart:min(blockStart + count, end)]
+            yield block, np.max(widths[block])
+        start = end
+
+
+def tileSpan(rangeMin, rangeMax, resolution, tileWidth):
+    #   the tiles covering rangeMin to rangeMax: the first tile, the number of tiles and the samples per tile.
+    #   tile t holds samples t * tileSamples up to (t + 1) * tileSamples of the grid that starts at 0 cm-1.
+    tileSamples = max(int(round(tileWidth / resolution)), 1)
+    firstTile = int(np.floor(rangeMin / resolution / tileSamples))
+    lastTile = int(np.floor(rangeMax / resolution / tileSamples))
+    return firstTile, lastTile - firstTile + 1, tileSamples
+
+
+def gridSpan(rangeMin, rangeMax, resolution):
+    #   the samples covering rangeMin to rangeMax on the grid that starts at 0 cm-1, as the first sample and the
+    #   number of samples. The span reaches one sample past rangeMax, so every wavenumber of the range lies
+    #   between two computed samples.
+    firstSample = int(np.floor(rangeMin / resolution))
+    return firstSample, int(np.floor(rangeMax / resolution)) - firstSample + 2
+
+
+def gridWavenumbers(gridOffset, gridLength, resolution):
+    #   wavenumber of every sample of an engine grid that starts gridOffset samples past 0 cm-1. Sample i holds
+    #   the lines centered within one resolution above it, see gridIndex.
+    return (gridOffset + np.arange(gridLength)) * resolution
+
+
+def tileRuns(tiles):
+    #   splits a sorted list of tile numbers into runs of consecutive tiles, as (first tile, tile count)
+    runs = []
+    for tile in tiles:
+        if runs and runs[-1][0] + runs[-1][1] == tile:
+            runs[-1][1] += 1
+        else:
+            runs.append([tile, 1])
+    return [tuple(run) for run in runs]
+
+
+def gridIndex(wavenumbers, gridMin, resolution, gridOffset):
+    #   grid sample of each line center. gridOffset shifts the grid to a chunk that starts gridOffset samples
+    #   past gridMin, while the lines still land exactly where they would on the whole grid.
+    return np.trunc((np.asarray(wavenumbers) - gridMin) / resolution).astype(int) - gridOffset
+
+
+def lineByLine(wavenumbers, intensities, gaussianHW, lorentzHW, gridMin, resolution, gridLength, distanceFromCenter,
+               gridOffset=0):
+    #   array version of the original per line / per dx loop in Isotope.createCrossSection.
+    #   wavenumbers, intensities (already temperature scaled) and halfwidths are 1-d arrays, one entry per line.
+    #   each line is centered at int((wavenumber - gridMin) / resolution) and spread out to distanceFromCenter
+    #   on both sides, a single cutoff or one per line. As with the loop, the outermost sample of each wing
+    #   is dropped. Every line uses the voigt profile served from the normalized profile table
+    #   (ls.voigtTableShape, within 1e-4 of the exact profile), so there is no switching between gaussian,
+    #   lorentz and pseudo voigt shapes.
+    grid = np.zeros(gridLength)
+    if len(wavenumbers) == 0:
+        return grid
+    samples = cutoffSamples(distanceFromCenter, resolution, len(wavenumbers))
+    centerIndex = gridIndex(wavenumbers, gridMin, resolution, gridOffset)
+    return addProfiles(grid, centerIndex, samples, intensities, gaussianHW, lorentzHW, resolution)
+
+
+def addProfiles(grid, centerIndex, samples, intensities, gaussianHW, lorentzHW, resolution):
+    #   adds the lines centered on grid samples centerIndex, with samples in each wing, into grid
+    gaussianHW = np.asarray(gaussianHW, dtype=float)
+    lorentzHW = np.asarray(lorentzHW, dtype=float)
+    intensities = np.asarray(intensities, dtype=float)
+    for block, width in widthBlocks(samples):
+        xValues = np.arange(width) * resolution
+        rightCurve = ls.voigtTableShape(gaussianHW[block], lorentzHW[block], xValues)
+        rightCurve *= intensities[block, np.newaxis]
+        if np.min(samples[block]) < width:
+            rightCurve[np.arange(width) >= samples[block, np.newaxis]] = 0
+        fullCurve = np.concatenate((rightCurve[:, :0:-1], rightCurve), axis=1)
+        scatterAdd(grid, centerIndex[block], np.arange(-width + 1, width), fullCurve)
+    return grid
+
+
+def temperatureDerivative(wavenumbers, intensities, intensityDerivatives, gaussianHW, gaussianDerivatives, lorentzHW,
+                          lorentzDerivatives, gridMin, resolution, gridLength, distanceFromCenter, gridOffset=0):
+    #   d(cross section) / dT on the lineByLine grid, from the derivatives of the intensities and halfwidths of
+    #   every line by temperature. Lines are placed and cut off as in lineByLine, with the analytic derivatives
+    #   of the voigt profile by its halfwidths (ls.voigtDerivatives). The cutoffs are held fixed.
+    grid = np.zeros(gridLength)
+    if len(wavenumbers) == 0:
+        return grid
+    samples = cutoffSamples(distanceFromCenter, resolution, len(wavenumbers))
+    centerIndex = gridIndex(wavenumbers, gridMin, resolution, gridOffset)
+    intensities, intensityDerivatives, gaussianHW, gaussianDerivatives, lorentzHW, lorentzDerivatives = [
+        np.asarray(values, dtype=float) for values in (intensities, intensityDerivatives, gaussianHW,
+                                                       gaussianDerivatives, lorentzHW, lorentzDerivatives)]
+    for block, width in widthBlocks(samples):
+        lineShape, byGaussian, byLorentz = ls.voigtDerivatives(gaussianHW[block], lorentzHW[block],
+                                                               np.arange(width) * resolution)
+        rightCurve = lineShape * intensityDerivatives[block, np.newaxis]
+        rightCurve += (byGaussian * gaussianDerivatives[block, np.newaxis] +
+                       byLorentz * lorentzDerivatives[block, np.newaxis]) * intensities[block, np.newaxis]
+        if np.min(samples[block]) < width:
+            rightCurve[np.arange(width) >= samples[block, np.newaxis]] = 0
+        fullCurve = np.concatenate((rightCurve[:, :0:-1], rightCurve), axis=1)
+        scatterAdd(grid, centerIndex[block], np.arange(-width + 1, width), fullCurve)
+    return grid
+
+
+def lineByLineLayers(wavenumbers, intensities, gaussianHW, lorentzHW, gridMin, resolution, gridLength,
+                     distanceFromCenter, gridOffset=0):
+    #   lineByLine for many layers sharing one grid and one line list, in a single pass over the lines.
+    #   intensities, halfwidths and cutoffs are layers x lines, wavenumbers are one row per layer or one for all.
+    #   Each layer gets its own stretch of one long grid, padded by the widest cutoff on both sides, so the
+    #   wings of every layer are added in the same blocks without spilling into the next layer.
+    #   Returns the cross sections as layers x gridLength.
+    intensities = np.asarray(intensities, dtype=float)
+    layerCount, lineCount = intensities.shape
+    if lineCount == 0:
+        return np.zeros((layerCount, gridLength))
+    samples = cutoffSamples(np.broadcast_to(distanceFromCenter, intensities.shape).ravel(), resolution,
+                            intensities.size).reshape(layerCount, lineCount)
+    pad = int(np.max(samples))
+    centerIndex = gridIndex(np.broadcast_to(wavenumbers, intensities.shape), gridMin, resolution, gridOffset)
+    #   lines centered further than their cutoff outside of the grid can't reach it
+    inGrid = (centerIndex > -samples) & (centerIndex < gridLength + samples)
+    layer = np.nonzero(inGrid)[0]
+    grid = np.zeros(layerCount * (gridLength + 2 * pad))
+    addProfiles(grid, centerIndex[inGrid] + pad + layer * (gridLength + 2 * pad), samples[inGrid],
+                intensities[inGrid], np.asarray(gaussianHW)[inGrid], np.asarray(lorentzHW)[inGrid], resolution)
+    return grid.reshape(layerCount, gridLength + 2 * pad)[:, pad:pad + gridLength]
+
+
+def classNodes(halfWidths, classes):
+    #   log spaced halfwidth classes spanning the line list. Each line is split between the two nearest
+    #   classes, weighted by its position between them in log space, which keeps the error second order.
+    #   returns the class halfwidths, the lower class of every line and the weight that goes to the upper class.
+    widthMin = np.min(halfWidths)
+    widthMax = np.max(halfWidths)
+    if classes < 2 or widthMax <= widthMin * (1 + 1E-9):
+        return np.array([np.sqrt(widthMin * widthMax)]), np.zeros(len(halfWidths), dtype=int), \
+               np.zeros(len(halfWidths))
+    nodes = np.geomspace(widthMin, widthMax, classes)
+    position = np.log(halfWidths / widthMin) / np.log(widthMax / widthMin) * (classes - 1)
+    lowerClass = np.clip(np.floor(position).astype(int), 0, classes - 2)
+    return nodes, lowerClass, position - lowerClass
+
+
+def fftConvolution(wavenumbers, intensities, gaussianHW, lorentzHW, gridMin, resolution, gridLength,
+                   distanceFromCenter, gridOffset=0, halfwidthClasses=FFT_HALFWIDTH_CLASSES):
+    #   builds a line survey of the temperature scaled intensities for every (gaussian, lorentz) halfwidth class
+    #   and convolves each survey with the line shape of its class. The products are summed in frequency space,
+    #   so there is one inverse transform per isotope. Cost is O(N log N) per class instead of O(lines x kernel).
+    #   Lines are placed and cut off exactly as in lineByLine; the only error comes from the halfwidth classes.
+    #   The kernels are shared by every line, so per line cutoffs are widened to the largest of them.
+    grid = np.zeros(gridLength)
+    if len(wavenumbers) == 0:
+        return grid
+    xValues = np.arange(0, np.max(distanceFromCenter), resolution)[:-1]
+    if len(xValues) == 0:
+        return grid
+    wing = len(xValues) - 1
+    intensities = np.asarray(intensities, dtype=float)
+    #   the survey is padded by a wing on each side so lines just outside of the window still contribute
+    surveyIndex = gridIndex(wavenumbers, gridMin, resolution, gridOffset) + wing
+    surveyLength = gridLength + 2 * wing
+    inSurvey = (surveyIndex >= 0) & (surveyIndex < surveyLength)
+    surveyIndex = surveyIndex[inSurvey]
+    intensities = intensities[inSurvey]
+    if len(surveyIndex) == 0:
+        return grid
+    gaussianNodes, gaussianClass, gaussianWeight = classNodes(np.asarray(gaussianHW)[inSurvey], halfwidthClasses)
+    lorentzNodes, lorentzClass, lorentzWeight = classNodes(np.asarray(lorentzHW)[inSurvey], halfwidthClasses)
+    fftLength = 2**int(np.ceil(np.log2(surveyLength + 2 * wing)))
+    spectrum = np.zeros(int(fftLength / 2) + 1, dtype=complex)
+    classIndex = []
+    classWeight = []
+    for gStep, gFraction in ((0, 1 - gaussianWeight), (1, gaussianWeight)):
+        for lStep, lFraction in ((0, 1 - lorentzWeight), (1, lorentzWeight)):
+            classIndex.append((gaussianClass + gStep) * len(lorentzNodes) + lorentzClass + lStep)
+            classWeight.append(intensities * gFraction * lFraction)
+    classIndex = np.concatenate(classIndex)
+    classWeight = np.concatenate(classWeight)
+    surveyIndex = np.tile(surveyIndex, 4)
+    for classNumber in np.unique(classIndex[classWeight > 0]):
+        member = classIndex == classNumber
+        survey = np.bincount(surveyIndex[member], weights=classWeight[member], minlength=surveyLength)
+        rightCurve = ls.voigtTableShape(gaussianNodes[int(classNumber / len(lorentzNodes))],
+                                        lorentzNodes[classNumber % len(lorentzNodes)], xValues)[0]
+        kernel = np.concatenate((rightCurve[:0:-1], rightCurve))
+        spectrum += np.fft.rfft(survey, fftLength) * np.fft.rfft(kernel, fftLength)
+    convolved = np.fft.irfft(spectrum, fftLength)
+    #   survey index s and kernel index t land on grid index s + t - 2 * wing
+    grid = convolved[2 * wing:2 * wing + gridLength]
+    #   round off in the transforms can leave tiny negative values far from any line
+    return np.maximum(grid, 0)
+
+
+def twoGrid(wavenumbers, intensities, gaussianHW, lorentzHW, gridMin, resolution, gridLength, distanceFromCenter,
+            gridOffset=0, coarseFactor=TWO_GRID_FACTOR, coreSteps=TWO_GRID_CORE_STEPS):
+    #   splits each line into a smooth wing and a narrow core, as LBLRTM does. Inside the core halfwidth C the
+    #   wing is the parabola a + b x^2 that meets the profile with the same value and slope at C. The wing is
+    #   accumulated on a grid coarseFactor times coarser and interpolated back once, and only the core, the
+    #   profile minus the parabola, is evaluated on the fine grid. C is coreSteps coarse samples, but never less
+    #   than the reach of the table core in ls.voigtTableShape so the wing can use the closed form expression.
+    #   Lines whose core covers the whole cutoff are evaluated on the fine grid only.
+    grid = np.zeros(gridLength)
+    if len(wavenumbers) == 0:
+        return grid
+    samples = cutoffSamples(distanceFromCenter, resolution, len(wavenumbers))
+    lastOffset = samples - 1
+    centerIndex = gridIndex(wavenumbers, gridMin, resolution, gridOffset)
+    gaussianHW = np.asarray(gaussianHW, dtype=float)
+    lorentzHW = np.asarray(lorentzHW, dtype=float)
+    intensities = np.asarray(intensities, dtype=float)
+    coreDistance = np.maximum(15 * gaussianHW - lorentzHW, coreSteps * coarseFactor * resolution)
+    coreSamples = np.minimum(np.ceil(coreDistance / resolution).astype(int), samples)
+    hasWing = coreSamples < samples
+    #   value and slope of the profile at the core edge, from the closed form wing
+    wingA = lorentzHW**2 + gaussianHW**2 / 2
+    edgeValue = ls.humlicekWing(coreDistance**2, lorentzHW, wingA)
+    step = coreDistance * 1E-6
+    edgeSlope = (ls.humlicekWing((coreDistance + step)**2, lorentzHW, wingA) - edgeValue) / step
+    parabolaB = np.where(hasWing, edgeSlope / (2 * coreDistance), 0)
+    parabolaA = np.where(hasWing, edgeValue - parabolaB * coreDistance**2, 0)
+    for block, width in widthBlocks(coreSamples):
+        core = np.arange(width) * resolution
+        rightCurve = ls.voigtTableShape(gaussianHW[block], lorentzHW[block], core)
+        rightCurve -= parabolaA[block, np.newaxis] + parabolaB[block, np.newaxis] * core**2
+        if np.min(coreSamples[block]) < width:
+            rightCurve[np.arange(width) >= coreSamples[block, np.newaxis]] = 0
+        rightCurve *= intensities[block, np.newaxis]
+        fullCurve = np.concatenate((rightCurve[:, :0:-1], rightCurve), axis=1)
+        scatterAdd(grid, centerIndex[block], np.arange(-width + 1, width), fullCurve)
+    if not np.any(hasWing):
+        return grid
+    #   wings on the coarse grid, coarse sample k sits on fine sample k * coarseFactor
+    coarse = np.zeros(int((gridLength - 1) / coarseFactor) + 2)
+    coarseCenter = np.floor_divide(centerIndex, coarseFactor)
+    coarseWidth = np.where(hasWing, lastOffset // coarseFactor + 2, 0)
+    for block, width in widthBlocks(coarseWidth):
+        coarseOffsets = np.arange(-width + 1, width)
+        fineOffset = (coarseCenter[block, np.newaxis] + coarseOffsets) * coarseFactor - centerIndex[block, np.newaxis]
+        fineOffset = np.abs(fineOffset)
+        xSquared = (fineOffset * resolution)**2
+        wing = ls.humlicekWing(xSquared, lorentzHW[block, np.newaxis], wingA[block, np.newaxis])
+        parabola = parabolaB[block, np.newaxis] * xSquared
+        parabola += parabolaA[block, np.newaxis]
+        np.copyto(wing, parabola, where=xSquared < coreDistance[block, np.newaxis]**2)
+        wing *= np.where(fineOffset > lastOffset[block, np.newaxis], 0, intensities[block, np.newaxis])
+        scatterAdd(coarse, coarseCenter[block], coarseOffsets, wing)
+    grid += np.interp(np.arange(gridLength), np.arange(len(coarse)) * coarseFactor, coarse)
+    return grid
+
+
+def relativeError(crossSection, reference):
+    #   returns the largest and the rms difference between two cross sections, both relative to the reference peak
+    peak = np.max(np.abs(reference))
+    if peak == 0:
+        return 0, 0
+    difference = np.abs(crossSection - reference) / peak
+    return np.max(difference), np.sqrt(np.mean(difference**2))
+
+
+#   line arrays of the parallel jobs, set in every worker by shareJobs
+sharedJobs = []
+
+CROSS_SECTION_METHODS = {'direct': lineByLine,
+                         'fft': fftConvolution,
+                         'twogrid': twoGrid}
+
+
+def computeCrossSection(method, wavenumbers, intensities, gaussianHW, lorentzHW, gridMin, resolution, gridLength,
+                        distanceFromCenter, gridOffset=0):
+    if method not in CROSS_SECTION_METHODS:
+        print('Unknown cross section method %s. Valid methods are %s' % (method, ', '.join(CROSS_SECTION_METHODS)))
+        method = 'direct'
+    return CROSS_SECTION_METHODS[method](wavenumbers, intensities, gaussianHW, lorentzHW, gridMin, resolution,
+                                         gridLength, distanceFromCenter, gridOffset=gridOffset)
+
+
+def shareJobs(jobs):
+    #   pool initializer. Each worker gets the line arrays of every job once, instead of once per task, and
+    #   where processes are forked it simply inherits them.
+    global sharedJobs
+    sharedJobs = jobs
+
+
+def computeChunk(jobIndex, chunkStart, chunkLength, gridMin, resolution):
+    #   one work unit: the cross section of one job over chunkLength samples starting chunkStart samples
+    #   past gridMin, from the lines that reach into the chunk. Lines are sorted by wavenumber.
+    #   gridMin stays where the whole grid starts, so lines land on the same samples in every chunk.
+    method, wavenumbers, intensities, gaussianHW, lorentzHW, distanceFromCenter = sharedJobs[jobIndex]
+    chunkMin = gridMin + chunkStart * resolution
+    reach = np.max(distanceFromCenter) + 2 * resolution
+    low = np.searchsorted(wavenumbers, chunkMin - reach)
+    high = np.searchsorted(wavenumbers, chunkMin + chunkLength * resolution + reach)
+    if np.ndim(distanceFromCenter):
+        distanceFromCenter = distanceFromCenter[low:high]
+    return computeCrossSection(method, wavenumbers[low:high], intensities[low:high], gaussianHW[low:high],
+                               lorentzHW[low:high], gridMin, resolution, chunkLength, distanceFromCenter,
+                               gridOffset=chunkStart)
+
+
+def parallelCrossSections(jobs, gridMin, resolution, gridLength, workers, gridOffset=0):
+    #   computes the cross section of every job, a tuple of (method, wavenumbers, intensities, gaussianHW,
+    #   lorentzHW, distanceFromCenter) as passed to computeCrossSection, over a process pool. The work units are
+    #   (job, spectral chunk) pairs and each chunk is written back into the grid of its job. Chunks start on
+    #   multiples of PARALLEL_CHUNK_MULTIPLE samples so the two grid coarse samples line up with the whole grid.
+    #   gridOffset starts the grid that many samples past gridMin, as for computeCrossSection.
+    sortedJobs = []
+    for method, wavenumbers, intensities, gaussianHW, lorentzHW, distanceFromCenter in jobs:
+        order = np.argsort(wavenumbers, kind='stable')
+        if np.ndim(distanceFromCenter):
+            distanceFromCenter = np.asarray(distanceFromCenter)[order]
+        sortedJobs.append((method, np.asarray(wavenumbers)[order], np.asarray(intensities)[order],
+                           np.asarray(gaussianHW)[order], np.asarray(lorentzHW)[order], distanceFromCenter))
+    chunkLength = int(np.ceil(gridLength / (workers * PARALLEL_CHUNKS_PER_WORKER) / PARALLEL_CHUNK_MULTIPLE))
+    chunkLength = max(chunkLength, 1) * PARALLEL_CHUNK_MULTIPLE
+    grids = [np.zeros(gridLength) for job in sortedJobs]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = None
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=shareJobs,
+                                                initargs=(sortedJobs,)) as executor:
+        futures = {}
+        for jobIndex in range(len(sortedJobs)):
+            for chunkStart in range(0, gridLength, chunkLength):
+                future = executor.submit(computeChunk, jobIndex, gridOffset + chunkStart,
+                                         min(chunkLength, gridLength - chunkStart), gridMin, resolution)
+                futures[future] = (jobIndex, chunkStart)
+        for future in concurrent.futures.as_completed(futures):
+            jobIndex, chunkStart = futures[future]
+            chunk = future.result()
+            grids[jobIndex][chunkStart:chunkStart + len(chunk)] = chunk
+    return grids
@@ -30,3 +30,10 @@ def stimulatedEmissions(wavenumber, t):
 def intensityFactor(intensity, wavenumber, t, lowerEnergy, q, q0):
     iF = intensity * (q0 / q) * (stimulatedEmissions(wavenumber, t)) * (boltzmannFactors(lowerEnergy, t))
     return iF
+
+
+def logIntensityDerivative(wavenumber, t, lowerEnergy, logQDerivative):
+    #   d ln(S) / dT of intensityFactor, from the boltzmann factor, the stimulated emissions and
+    #   logQDerivative, the d ln(Q) / dT of the partition function
+    x = c2 * wavenumber / t
+    return c2 * lowerEnergy / t**2 - x / t * np.exp(-x) / -np.expm1(-x) - logQDerivative
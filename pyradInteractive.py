@@ -4,6 +4,7 @@ import pyradClasses as pyrad
 import pyradUtilities as util
 import re
 import pyradPlanck
+import pyradCrossSection
 
 existingAtmosphere = False
 validValueAndUnits = re.compile('([-])?(\d+)?([.])?(\d+)?(\S+)?')
@@ -135,7 +136,9 @@ def menuEditLayerParam(layer):
     editRange = Entry('Min or max range', nextFunction=editLayerRange, functionParams=layer)
     editTemperature = Entry('Temperature',nextFunction=editLayerTemperature, functionParams=layer)
     editPressure = Entry('Pressure', nextFunction=editLayerPressure, functionParams=layer)
-    entryList = [editDepth, editRange, editTemperature, editPressure]
+    editMethod = Entry('Cross section method', nextFunction=editLayerCrossSectionMethod, functionParams=layer)
+    editCutoff = Entry('Line cutoff threshold', nextFunction=editLayerCutoffThreshold, functionParams=layer)
+    entryList = [editDepth, editRange, editTemperature, editPressure, editMethod, editCutoff]
     menu = Menu('Choose the parameter to edit for %s' % layer.name, entryList,
                 previousMenu=menuEditParamsOrComp, menuParams=layer)
     menu.displayMenu()
@@ -175,6 +178,43 @@ def editLayerRange(layer):
     menuEditLayerParam(layer)
 
 
+def editLayerCrossSectionMethod(layer):
+    print('Current %s for %s is : %s\n'
+          % (util.limeText('cross section method'), util.limeText(layer.name), util.cyanText(layer.crossSectionMethod)))
+    method = receiveInput('%s\n'
+                          'Valid methods are %s. If no value given, %s will be used: '
+                          % (util.underlineCyan('Enter the cross section method.\t\t\t'),
+                             util.limeText(', '.join(pyradCrossSection.CROSS_SECTION_METHODS)),
+                             util.limeText(layer.crossSectionMethod)), validCrossSectionMethod,
+                          default=layer.crossSectionMethod)
+    layer.changeCrossSectionMethod(method)
+    menuEditLayerParam(layer)
+
+
+def editLayerCutoffThreshold(layer):
+    mode = 'relative' if layer.relativeCutoff else 'absolute'
+    print('Current %s for %s is : %s\n'
+          % (util.limeText('line cutoff threshold'), util.limeText(layer.name),
+             util.cyanText(layer.cutoffThreshold if layer.cutoffThreshold is None
+                           else '%s (%s)' % (layer.cutoffThreshold, mode))))
+    threshold = receiveInput('%s\n'
+                             'Lines are cut off where their wing drops below this threshold. Enter %s to cut every '
+                             'line at the fixed distance instead. If no value given, %s will be used: '
+                             % (util.underlineCyan('Enter the line cutoff threshold.\t\t\t'), util.limeText('none'),
+                                util.limeText(layer.cutoffThreshold)), validCutoffThreshold,
+                             default=layer.cutoffThreshold)
+    relativeCutoff = layer.relativeCutoff
+    if threshold is not None:
+        mode = receiveInput('%s\n'
+                            'Enter %s for a fraction of the strongest line peak, or %s for a cross section in '
+                            'cm2/molecule / cm-1. If no value given, %s will be used: '
+                            % (util.underlineCyan('Enter the kind of threshold.\t\t\t'), util.limeText('relative'),
+                               util.limeText('absolute'), util.limeText(mode)), validCutoffMode, default=mode)
+        relativeCutoff = mode == 'relative'
+    layer.changeCutoff(threshold, relativeCutoff)
+    menuEditLayerParam(layer)
+
+
 def editComposition(molecule):
     print('Current concentration for %s is %s\n' % (util.limeText(molecule.name), util.limeText(molecule.concText)))
     return inputMoleculeComposition(molecule, default=molecule.concText)
@@ -411,11 +451,43 @@ def menuChoosePlotType(empty=None):
     entryList.append(Entry('optical depth', nextFunction=menuChooseLayerToPlot, functionParams='optical depth'))
     entryList.append(Entry('line survey', nextFunction=menuChooseLayerToPlot, functionParams='line survey'))
     entryList.append(Entry('transmission', nextFunction=menuChooseTransmission, functionParams='transmission'))
+    entryList.append(Entry('path lengths', nextFunction=menuChooseDepthPlotType))
     choosePlotTypeMenu = Menu('Choose plot type', entryList)
     choosePlotTypeMenu.displayMenu()
     return
 
 
+def menuChooseDepthPlotType(empty=None):
+    entryList = []
+    for plotType in ('transmittance', 'absorbance', 'emissivity'):
+        entryList.append(Entry(plotType, nextFunction=menuChooseLayerToPlotDepths, functionParams=plotType))
+    chooseDepthPlotTypeMenu = Menu('Choose plot type for several path lengths', entryList)
+    chooseDepthPlotTypeMenu.displayMenu()
+    return
+
+
+def menuChooseLayerToPlotDepths(plotType):
+    entryList = []
+    for layer in genericAtmosphere:
+        params = {'layer': layer, 'plotType': plotType}
+        entryList.append(Entry(layer.name, nextFunction=createDepthPlot, functionParams=params))
+    plotLayerMenu = Menu('Plot layer', entryList)
+    plotLayerMenu.displayMenu()
+    return
+
+
+def createDepthPlot(params):
+    text = 'Enter the path lengths to compare.\t\t\t'
+    depths = receiveMultiInput('%s\n'
+                               'If no units are specified, %s will be assumed.\n'
+                               'Other valid units are %s . Multiple path lengths can be separated with a comma: '
+                               % (util.underlineCyan(text),
+                                  util.limeText('cm'),
+                                  util.limeText('m, in, ft.')), validDepth)
+    pyrad.plotDepths(params['layer'], params['plotType'], [validDepth(depth) for depth in depths])
+    return
+
+
 def menuChooseLayerToPlot(plotType):
     entryList = []
     for layer in genericAtmosphere:
@@ -622,6 +694,41 @@ def validMoleculeName(userInput):
         return False
 
 
+def validCrossSectionMethod(userInput):
+    if not userInput:
+        return False
+    if userInput.strip().lower() in pyradCrossSection.CROSS_SECTION_METHODS:
+        return userInput.strip().lower()
+    print('Invalid method. %s' % (util.underlineMagenta('Please try again.')))
+    return False
+
+
+def validCutoffThreshold(userInput):
+    # None for no threshold, otherwise a threshold of 0 or more
+    if not userInput:
+        return False
+    if userInput.strip().lower() == 'none':
+        return None
+    threshold = validNumber(userInput)
+    if threshold is False or threshold < 0:
+        print('Invalid threshold. Enter a number of 0 or more, or %s. %s'
+              % (util.limeText('none'), util.underlineMagenta('Please try again.')))
+        return False
+    return threshold
+
+
+def validCutoffMode(userInput):
+    if not userInput:
+        return False
+    if userInput.strip().lower()[0] == 'r':
+        return 'relative'
+    if userInput.strip().lower()[0] == 'a':
+        return 'absolute'
+    print('Invalid option. Please type "%s" or "%s"'
+          % (util.underlineMagenta('relative'), util.underlineMagenta('absolute')))
+    return False
+
+
 def validPressure(userInput):
     if not userInput:
         return False
@@ -0,0 +1,58 @@
+import numpy as np
+
+pi = 3.141592653589793
+
+#   correlated-k distributions. Within a band, the absorption coefficients are sorted into a smooth, increasing
+#   k(g) over the cumulative fraction g of the band, which a few gaussian quadrature points integrate as well as
+#   the full spectrum does. Layers are sorted independently, which assumes their spectra are correlated.
+
+#   gauss-legendre points per band
+G_POINTS = 8
+
+
+def gaussPoints(gPoints=G_POINTS):
+    # gauss-legendre nodes and weights on 0 <= g <= 1
+    nodes, weights = np.polynomial.legendre.leggauss(gPoints)
+    return (nodes + 1) / 2, weights / 2
+
+
+def kDistribution(wavenumbers, absCoef, bandEdges, gPoints=G_POINTS):
+    # returns the k distribution of absCoef (cm-1) over wavenumbers (cm-1) for each band between consecutive
+    # bandEdges: a dict of the band edges, g points, weights and k (bands x g points). Empty bands get k = 0.
+    wavenumbers = np.asarray(wavenumbers, dtype=float)
+    absCoef = np.nan_to_num(np.asarray(absCoef, dtype=float))
+    bandEdges = np.asarray(bandEdges, dtype=float)
+    g, weights = gaussPoints(gPoints)
+    k = np.zeros((len(bandEdges) - 1, gPoints))
+    band = np.searchsorted(bandEdges, wavenumbers, 'right') - 1
+    for i in range(len(bandEdges) - 1):
+        sortedK = np.sort(absCoef[band == i])
+        if len(sortedK) == 0:
+            continue
+        k[i] = np.interp(g, (np.arange(len(sortedK)) + .5) / len(sortedK), sortedK)
+    return {'bandEdges': bandEdges, 'g': g, 'weights': weights, 'k': k}
+
+
+def bandTransmittance(kDist, depth):
+    # band mean transmittance through depth (cm) from a k distribution
+    return np.sum(kDist['weights'] * np.exp(-kDist['k'] * depth), axis=1)
+
+
+def bandTransmittanceLBL(wavenumbers, absCoef, bandEdges, depth):
+    # the same band means from the full spectrum, for checking a k distribution against
+    wavenumbers = np.asarray(wavenumbers, dtype=float)
+    transmittance = np.exp(-np.nan_to_num(np.asarray(absCoef, dtype=float)) * depth)
+    band = np.searchsorted(bandEdges, wavenumbers, 'right') - 1
+    inBands = (band >= 0) & (band < len(bandEdges) - 1)
+    counts = np.bincount(band[inBands], minlength=len(bandEdges) - 1)
+    sums = np.bincount(band[inBands], weights=transmittance[inBands], minlength=len(bandEdges) - 1)
+    return sums / np.maximum(counts, 1)
+
+
+def bandPower(kDist, depth, surfaceRadiance, layerRadiance, unitAngle=pi):
+    # band power leaving the layer (W/m2 with the default unitAngle, as for integrateSpectrum) above a surface,
+    # with surfaceRadiance and layerRadiance the planck radiance (W/m2/sr/cm-1) at each band center
+    width = np.diff(kDist['bandEdges'])
+    transmittance = np.exp(-kDist['k'] * depth)
+    radiance = surfaceRadiance[:, np.newaxis] * transmittance + layerRadiance[:, np.newaxis] * (1 - transmittance)
+    return np.sum(kDist['weights'] * radiance, axis=1) * width * unitAngle
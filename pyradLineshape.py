@@ -2,13 +2,6 @@ import numpy as np
 import pyradUtilities as utils
 
 
-#cachedVoigt = utils.getCurves('voigt', utils.BASE_RESOLUTION)
-#cachedLorentz = utils.getCurves('lorentz', utils.BASE_RESOLUTION)
-#cachedGaussian = utils.getCurves('gaussian', utils.BASE_RESOLUTION)
-cachedLorentz = {}
-cachedGaussian = {}
-newLorentz = {}
-newGaussian = {}
 print('\n', end='\r')
 
 h = 6.62607004e-34
@@ -17,6 +10,14 @@ k = 1.38064852E-23
 c = 299792458.0
 t0 = 296
 p0 = 1013.25
+ln2 = 0.6931471805599453
+
+#   normalized voigt profile table. Rows are the lorentz fraction lHW / (lHW + gaussian HWHM) and columns are
+#   x / voigt HWHM. Samples past 15 gaussian halfwidths (under 18 voigt halfwidths) use the far wing expression
+#   instead, which is exact to 1e-4 there. Memory is fixed: the table plus its packed copy are about 8MB.
+TABLE_STEP = .01
+TABLE_EXTENT = 20
+TABLE_FRACTIONS = 101
 
 
 def gaussianHW(wavenumber, t, m):
@@ -30,40 +31,20 @@ def lorentzHW(airHalfWidth, selfHalfWidth, P, T, q, tExponent):
 
 
 def gaussianLineShape(halfWidth, xValue):
-    if isinstance(xValue, np.ndarray) and str(halfWidth) in cachedGaussian:
-        length = len(xValue)
-        cachedCurve = cachedGaussian[str(halfWidth)]
-        if len(cachedCurve) >= length:
-            return cachedCurve[:length]
     """Returns the right half of a gaussian curve, used for temp broadening in low pressure scenarios"""
     lineShape = np.exp(-xValue**2 / halfWidth**2) / halfWidth / np.sqrt(pi)
-    cachedGaussian[halfWidth] = lineShape
-    newGaussian[halfWidth] = lineShape
     return lineShape
 
 
 def lorentzLineShape(halfWidth, xValue):
-    if isinstance(xValue, np.ndarray) and str(halfWidth) in cachedLorentz:
-        length = len(xValue)
-        cachedCurve = cachedLorentz[str(halfWidth)]
-        if len(cachedCurve) >= length:
-            return cachedCurve[:length]
     """Returns the right half of a lorentzian curve."""
     lineShape = halfWidth / pi / (xValue**2 + halfWidth**2)
-    cachedLorentz[halfWidth] = lineShape
-    newLorentz[halfWidth] = lineShape
     return lineShape
 
 
 def pseudoVoigtShape(gHW, lHW, xValue):
     gFW = 2 * gHW
     lFW = 2 * lHW
-#    cacheKey = '%s:%s' % (gFW, lFW)
-#    length = int(distanceFromCenter / dx)
-#    if cacheKey in cachedVoigt:
-#        cachedCurve = cachedVoigt[cacheKey]
-#        if len(cachedCurve) >= length:
-#            return cachedCurve[:length]
     fValue = (gFW**5 + 2.69269 * gFW**4 * lFW +
               2.42843 * gFW**3 * lFW**2 +
               4.47163 * gFW**2 * lFW**3 +
@@ -72,10 +53,211 @@ def pseudoVoigtShape(gHW, lHW, xValue):
     gCurve = gaussianLineShape(fValue / 2, xValue)
     lCurve = lorentzLineShape(fValue / 2, xValue)
     pseudoVoigt = nValue * lCurve + (1 - nValue) * gCurve
-#    cachedVoigt[cacheKey] = pseudoVoigt
     return pseudoVoigt
 
 
+def humlicekW4(x, y):
+    # real part of the Faddeeva function w(x + iy) from Humlicek's W4 rational approximation
+    # (JQSRT 27, 437, 1982), relative error below 1e-4. x and y are non-negative and broadcast together,
+    # usually x is (lines, samples) and y is a column with one entry per line.
+    # Region 1 (x + y >= 15) covers nearly every sample away from the line center and is done in real
+    # arithmetic. The complex regions are only evaluated over the columns that need them.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    wReal = humlicekWing(x**2, y) * np.sqrt(pi)
+    core = x + y < 15
+    if not core.any():
+        return wReal
+    coreColumns = np.nonzero(np.reshape(core, (-1, core.shape[-1])).any(axis=0))[0][-1] + 1
+    xCore, yCore = np.broadcast_arrays(*[a[..., :coreColumns] if a.ndim and a.shape[-1] > 1 else a for a in (x, y)])
+    sCore = xCore + yCore
+    t = yCore - 1j * xCore
+    u = t * t
+    with np.errstate(over='ignore', invalid='ignore'):
+        w = np.where(sCore >= 5.5,
+                     t * (1.410474 + u * .5641896) / (.75 + u * (3 + u)),
+                     np.where(yCore >= .195 * xCore - .176,
+                              (16.4955 + t * (20.20933 + t * (11.96482 + t * (3.778987 + t * .5642236)))) /
+                              (16.4955 + t * (38.82363 + t * (39.27121 + t * (21.69274 + t * (6.699398 + t))))),
+                              np.exp(u) - t * (36183.31 - u * (3321.9905 - u * (1540.787 - u * (219.0313 - u * (
+                                  35.76683 - u * (1.320522 - u * .56419)))))) /
+                              (32066.6 - u * (24322.84 - u * (9022.228 - u * (2186.181 - u * (364.2191 - u * (
+                                  61.57037 - u * (1.841439 - u)))))))))
+    wReal = np.broadcast_to(wReal, np.broadcast(x, y).shape).copy()
+    wReal[..., :coreColumns] = np.where(sCore < 15, w.real, wReal[..., :coreColumns])
+    return wReal
+
+
+def faddeeva(x, y):
+    # the complex Faddeeva function w(x + iy) from the same W4 regions as humlicekW4, for the profile
+    # derivatives, which need its imaginary part too. Slower than humlicekW4, every region is complex.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    s = x + y
+    t = y - 1j * x
+    u = t * t
+    with np.errstate(over='ignore', invalid='ignore'):
+        return np.where(s >= 15, t * .5641896 / (.5 + u),
+                        np.where(s >= 5.5,
+                                 t * (1.410474 + u * .5641896) / (.75 + u * (3 + u)),
+                                 np.where(y >= .195 * x - .176,
+                                          (16.4955 + t * (20.20933 + t * (11.96482 + t * (3.778987 + t * .5642236))))
+                                          / (16.4955 + t * (38.82363 + t * (39.27121 + t * (21.69274 + t * (
+                                              6.699398 + t))))),
+                                          np.exp(u) - t * (36183.31 - u * (3321.9905 - u * (1540.787 - u * (
+                                              219.0313 - u * (35.76683 - u * (1.320522 - u * .56419)))))) /
+                                          (32066.6 - u * (24322.84 - u * (9022.228 - u * (2186.181 - u * (
+                                              364.2191 - u * (61.57037 - u * (1.841439 - u))))))))))
+
+
+def voigtDerivatives(gHW, lHW, xValues):
+    # the right half of the voigt curve of every line, as voigtShape, with its derivatives by the gaussian and
+    # the lorentz halfwidth. The far wing expression is differentiated directly. Closer in, with
+    # z = (x + i lHW) / gHW, the profile is Re w(z) / (gHW sqrt(pi)) and dw/dz = 2i / sqrt(pi) - 2 z w; only the
+    # columns that reach within 15 gHW of a line center take the complex w.
+    gHW = np.reshape(gHW, (-1, 1))
+    lHW = np.reshape(lHW, (-1, 1))
+    xValues = np.abs(np.asarray(xValues, dtype=float))
+    # the wing, (lHW / pi) * n / d with n = a + x^2, d = (a - x^2)^2 + 4 x^2 lHW^2 and a = lHW^2 + gHW^2 / 2
+    xSquared = xValues**2
+    a = lHW**2 + gHW**2 / 2
+    numerator = a + xSquared
+    denominator = (a - xSquared)**2 + 4 * xSquared * lHW**2
+    byA = lHW / pi * (denominator - 2 * numerator * (a - xSquared)) / denominator**2
+    lineShape = lHW / pi * numerator / denominator
+    gaussianDerivative = byA * gHW
+    lorentzDerivative = numerator / denominator / pi - 8 * lHW**2 * xSquared * numerator / pi / denominator**2 + \
+        byA * 2 * lHW
+    coreDistance = 15 * gHW - lHW
+    if np.all(np.diff(xValues) >= 0):
+        coreColumns = np.searchsorted(xValues, np.max(coreDistance))
+    else:
+        coreColumns = len(xValues)
+    if coreColumns == 0:
+        return lineShape, gaussianDerivative, lorentzDerivative
+    x = xValues[:coreColumns] / gHW
+    y = lHW / gHW
+    w = faddeeva(x, y)
+    dRealDx = -2 * (x * w.real - y * w.imag)
+    dRealDy = 2 * (x * w.imag + y * w.real) - 2 / np.sqrt(pi)
+    norm = 1 / gHW / np.sqrt(pi)
+    core = xValues[:coreColumns] < coreDistance
+    coreShape = w.real * norm
+    lineShape[:, :coreColumns] = np.where(core, coreShape, lineShape[:, :coreColumns])
+    lorentzDerivative[:, :coreColumns] = np.where(core, dRealDy * norm / gHW, lorentzDerivative[:, :coreColumns])
+    gaussianDerivative[:, :coreColumns] = np.where(core, -coreShape / gHW - (x * dRealDx + y * dRealDy) * norm / gHW,
+                                                   gaussianDerivative[:, :coreColumns])
+    return lineShape, gaussianDerivative, lorentzDerivative
+
+
+def humlicekWing(xSquared, y, a=None):
+    # Humlicek's region 1, the far wing of the voigt profile in real arithmetic: (y / pi) * (a + x^2) /
+    # ((a - x^2)^2 + 4 x^2 y^2) with a = y^2 + .5. In doppler units this is Re w(x + iy) / sqrt(pi).
+    # With x and y in cm-1 and a = y^2 + gHW^2 / 2 it is the profile itself, valid for x + y >= 15 gHW.
+    if a is None:
+        a = y**2 + .5
+    denominator = a - xSquared
+    denominator *= denominator
+    denominator += xSquared * (4 * y**2)
+    wing = xSquared + a
+    wing *= y / pi
+    wing /= denominator
+    return wing
+
+
+def voigtHW(gHW, lHW):
+    # voigt halfwidth at half maximum from Olivero and Longbothum (JQSRT 17, 233, 1977), good to .02%
+    gaussianHWHM = gHW * np.sqrt(ln2)
+    return .5346 * lHW + np.sqrt(.2166 * lHW**2 + gaussianHWHM**2)
+
+
+def buildProfileTable():
+    # voigt profile times its halfwidth, sampled at x / voigt halfwidth for each lorentz fraction.
+    # the pure lorentz row is written directly since it has no gaussian width to normalize by.
+    fractions = np.linspace(0, 1, TABLE_FRACTIONS)
+    lHW = fractions
+    gHW = (1 - fractions) / np.sqrt(ln2)
+    width = voigtHW(gHW, lHW)
+    normalizedX = np.arange(0, TABLE_EXTENT + TABLE_STEP / 2, TABLE_STEP)
+    table = np.empty((TABLE_FRACTIONS, len(normalizedX)))
+    table[:-1] = width[:-1, np.newaxis] * voigtShape(gHW[:-1], lHW[:-1], normalizedX * width[:-1, np.newaxis])
+    table[-1] = lorentzLineShape(lHW[-1], normalizedX * width[-1]) * width[-1]
+    return table
+
+
+def packProfileTable(table):
+    # stores the four numbers needed for a bilinear lookup next to each other: value and slope along x for
+    # this lorentz fraction row and for the next one. A single gather then serves each sample.
+    packed = np.zeros((table.shape[0] - 1, table.shape[1], 4))
+    packed[:, :, 0] = table[:-1]
+    packed[:, :-1, 1] = np.diff(table[:-1], axis=1)
+    packed[:, :, 2] = table[1:]
+    packed[:, :-1, 3] = np.diff(table[1:], axis=1)
+    return np.reshape(packed, (-1, 4))
+
+
+def voigtTableShape(gHW, lHW, xValues):
+    """Returns the right half of a voigt curve for every line, one row per line, interpolated from the
+    normalized profile table near the line center and from the far wing expression elsewhere.
+    Agrees with voigtShape to 1e-4 of the peak. No exp is taken and the table never grows."""
+    gHW = np.reshape(gHW, (-1, 1))
+    lHW = np.reshape(lHW, (-1, 1))
+    xValues = np.abs(np.asarray(xValues, dtype=float))
+    lineShape = humlicekWing(xValues**2, lHW, lHW**2 + gHW**2 / 2)
+    # the wing expression holds for x + lHW >= 15 gHW, only samples closer in than that use the table
+    coreDistance = 15 * gHW - lHW
+    if np.all(np.diff(xValues) >= 0):
+        coreColumns = np.searchsorted(xValues, np.max(coreDistance))
+    else:
+        coreColumns = len(xValues)
+    if coreColumns == 0:
+        return lineShape
+    width = voigtHW(gHW, lHW)
+    columns = np.shape(profileTable)[1]
+    position = xValues[:coreColumns] * (1 / TABLE_STEP / width)
+    index = np.minimum(position, columns - 2).astype(int)
+    position -= index
+    fraction = lHW / (lHW + gHW * np.sqrt(ln2)) * (TABLE_FRACTIONS - 1)
+    row = np.minimum(fraction.astype(int), TABLE_FRACTIONS - 2)
+    fraction -= row
+    table = packedProfileTable[index + row * columns]
+    core = (table[..., 0] + table[..., 1] * position) * ((1 - fraction) / width) + \
+        (table[..., 2] + table[..., 3] * position) * (fraction / width)
+    lineShape[:, :coreColumns] = np.where(xValues[:coreColumns] < coreDistance, core, lineShape[:, :coreColumns])
+    return lineShape
+
+
+def voigtShape(gHW, lHW, xValues):
+    """Returns the right half of a voigt curve for every line, one row per line.
+    gHW is the gaussian 1/e halfwidth and lHW the lorentz halfwidth, given as scalars or one entry per line.
+    Valid from the doppler to the pressure broadened limit, so no switching between shapes is needed."""
+    gHW = np.reshape(gHW, (-1, 1))
+    lHW = np.reshape(lHW, (-1, 1))
+    lineShape = humlicekW4(np.abs(np.asarray(xValues)) * (1 / gHW), lHW / gHW)
+    lineShape *= 1 / gHW / np.sqrt(pi)
+    return lineShape
+
+
+def benchmarkVoigt(lineCount=1000, distanceFromCenter=5, resolution=utils.BASE_RESOLUTION, P=p0, T=t0):
+    # times the per line pseudoVoigtShape path against a single voigtShape call for a set of co2-like lines
+    # and reports how far the pseudo voigt is from the exact profile.
+    import time
+    wavenumbers = np.linspace(500, 1300, lineCount)
+    gHW = gaussianHW(wavenumbers, T, 44 / 1000 / 6.022140857E23)
+    lHW = lorentzHW(np.linspace(.05, .09, lineCount), np.linspace(.07, .11, lineCount), P, T, 4E-4, .7)
+    xValues = np.arange(0, distanceFromCenter, resolution)
+    start = time.time()
+    pseudoVoigt = np.array([pseudoVoigtShape(g, l, xValues) for g, l in zip(gHW, lHW)])
+    pseudoTime = time.time() - start
+    start = time.time()
+    voigt = voigtShape(gHW, lHW, xValues)
+    voigtTime = time.time() - start
+    pseudoError = np.max(np.abs(pseudoVoigt - voigt)) / np.max(voigt)
+    print('%s lines x %s samples: pseudo voigt %.4fs, voigt %.4fs (%.1fx), pseudo voigt error %.2e of peak'
+          % (lineCount, len(xValues), pseudoTime, voigtTime, pseudoTime / voigtTime, pseudoError))
+    return {'pseudoVoigt': pseudoTime, 'voigt': voigtTime, 'pseudoVoigtError': pseudoError}
+
+
 def broadenLineList(p, wavenumber, pressureShift):
     new = wavenumber + pressureShift * p / p0
     return new
@@ -96,12 +278,27 @@ def vvLineShape(halfwidth, centerWavenumber, xValues):
     return vvRightCurve
 
 
+def tableKeys():
+    # keys carry the extent so a table stored with other settings is never mistaken for this one
+    return ['%s:%.4f' % (TABLE_EXTENT, fraction) for fraction in np.linspace(0, 1, TABLE_FRACTIONS)]
+
+
+def loadProfileTable():
+    # reads the profile table from the binary curve store, building and storing it on the first run
+    cachedVoigt = utils.getCurves('voigt', TABLE_STEP)
+    columns = int(round(TABLE_EXTENT / TABLE_STEP)) + 1
+    if all(key in cachedVoigt and len(cachedVoigt[key]) == columns for key in tableKeys()):
+        return np.array([cachedVoigt[key] for key in tableKeys()])
+    table = buildProfileTable()
+    utils.writeCurveToFile(dict(zip(tableKeys(), table)), 'voigt', TABLE_STEP)
+    return table
+
+
 def writeCacheToFile():
-    print('Writing new line shapes to file...', end='', flush=True)
-    utils.writeCurveToFile(newGaussian, 'gaussian', utils.BASE_RESOLUTION)
-    utils.writeCurveToFile(newLorentz, 'lorentz', utils.BASE_RESOLUTION)
-    print('%s added.' % (len(newLorentz) + len(newGaussian)))
-#   utils.writeCurveToFile(cachedVoigt, 'voigt', utils.BASE_RESOLUTION)
+    print('Writing voigt profile table to file...', end='', flush=True)
+    added = utils.writeCurveToFile(dict(zip(tableKeys(), profileTable)), 'voigt', TABLE_STEP)
+    print('%s added.' % added)
+
 
 #   simply used to validate the shape of the pseudo curve in testing
 
@@ -111,3 +308,7 @@ def writeCacheToFile():
     sigma = lHW / np.sqrt(2 * np.log(2))
     return np.real(wofz((xValue + 1j * gHW) / sigma / np.sqrt(2))) / sigma \
            / np.sqrt(2*np.pi)'''
+
+
+profileTable = loadProfileTable()
+packedProfileTable = packProfileTable(profileTable)
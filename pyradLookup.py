@@ -0,0 +1,232 @@
+import os
+import numpy as np
+import pyradUtilities as utils
+
+#   absorption lookup tables, one per isotope, of cross sections over (temperature, log pressure, wavenumber).
+#   The cross sections are stored in a memory mapped .npy file and the axes next to it in a .axes.npz file, with
+#   the concentration, method and line cutoffs the table was built with.
+lookupDir = '%s/lookup' % utils.dataDir
+
+#   lookup tables loaded so far, {global isotope id: {table name: table}}, in the order they were loaded
+lookupTables = {}
+
+#   principal components kept by a compressed table, and the floor below which cross sections are clipped before
+#   taking their log, relative to the largest cross section. Rows are processed COMPRESSION_CHUNK samples at a time.
+COMPRESSION_COMPONENTS = 8
+COMPRESSION_FLOOR = 1E-12
+COMPRESSION_CHUNK = 2**16
+
+
+def lookupPaths(name):
+    if not os.path.isdir(lookupDir):
+        os.makedirs(lookupDir)
+    return '%s/%s.npy' % (lookupDir, name), '%s/%s.axes.npz' % (lookupDir, name)
+
+
+def createTable(name, globalIsoId, temperatures, pressures, wavenumbers, concentration, method, cutoffThreshold,
+                relativeCutoff):
+    # writes the axes and settings and returns the memory mapped cross section array of a new table, to be
+    # filled in. A cutoffThreshold of None is saved as nan.
+    tablePath, axesPath = lookupPaths(name)
+    np.savez(axesPath, globalIsoId=globalIsoId, temperature=temperatures, pressure=pressures,
+             wavenumber=wavenumbers, concentration=concentration, method=method,
+             cutoffThreshold=np.nan if cutoffThreshold is None else cutoffThreshold, relativeCutoff=relativeCutoff)
+    return np.lib.format.open_memmap(tablePath, mode='w+', dtype=float,
+                                     shape=(len(temperatures), len(pressures), len(wavenumbers)))
+
+
+def loadTable(name):
+    # memory maps a saved table and registers it for its isotope. Returns the global isotope id.
+    tablePath, axesPath = lookupPaths(name)
+    if not os.path.isfile(tablePath) or not os.path.isfile(axesPath):
+        print('No lookup table named %s in %s' % (name, lookupDir))
+        return False
+    table = readAxes(name)
+    if not table:
+        return False
+    table['crossSection'] = np.load(tablePath, mmap_mode='r')
+    registerTable(table)
+    return table['globalIsoId']
+
+
+def readAxes(name):
+    # the axes and settings of a saved table, as a table dict without its cross sections
+    axes = np.load(lookupPaths(name)[1])
+    if 'concentration' not in axes.files:
+        print('Lookup table %s was saved without the settings it was built with. Rebuild it.' % name)
+        return False
+    cutoffThreshold = float(axes['cutoffThreshold'])
+    return {'name': name,
+            'globalIsoId': int(axes['globalIsoId']),
+            'temperature': axes['temperature'],
+            'logPressure': np.log(axes['pressure']),
+            'wavenumber': axes['wavenumber'],
+            'concentration': float(axes['concentration']),
+            'method': str(axes['method']),
+            'cutoffThreshold': None if np.isnan(cutoffThreshold) else cutoffThreshold,
+            'relativeCutoff': bool(axes['relativeCutoff'])}
+
+
+def registerTable(table):
+    # adds a table to the tables of its isotope, replacing a table loaded earlier under the same name
+    tables = lookupTables.setdefault(table['globalIsoId'], {})
+    tables.pop(table['name'], None)
+    tables[table['name']] = table
+
+
+def compressRows(rows, components=COMPRESSION_COMPONENTS, logSpace=False):
+    # compresses a batch of cross sections, rows x wavenumber, such as the flattened (T, P) grid of a table or a
+    # list of isotope cross sections, into their mean plus a few principal components, one coefficient per row
+    # and component. With logSpace the log of the cross sections is compressed instead, which keeps the relative
+    # error of weak wings small but spreads the error of a few components into the line peaks, where it grows
+    # exponentially. rows may be memory mapped, it is read in chunks of wavenumber. The returned dict has the
+    # largest and rms reconstruction error relative to the largest cross section.
+    rows = rows if isinstance(rows, np.ndarray) else np.asarray(rows, dtype=float)
+    rowCount, length = rows.shape
+    chunks = [slice(start, min(start + COMPRESSION_CHUNK, length)) for start in range(0, length, COMPRESSION_CHUNK)]
+    peak = max(np.max(rows[:, chunk]) for chunk in chunks)
+    floor = peak * COMPRESSION_FLOOR
+
+    def values(chunk):
+        if logSpace:
+            return np.log(np.maximum(rows[:, chunk], floor))
+        return np.array(rows[:, chunk], dtype=float)
+
+    mean = np.zeros(length)
+    gram = np.zeros((rowCount, rowCount))
+    for chunk in chunks:
+        chunkValues = values(chunk)
+        mean[chunk] = np.mean(chunkValues, axis=0)
+        chunkValues -= mean[chunk]
+        gram += chunkValues @ chunkValues.T
+    # the row space of the centered rows is small, so the components come from its gram matrix
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    keep = np.argsort(eigenvalues)[::-1][:components]
+    keep = keep[eigenvalues[keep] > eigenvalues.max() * 1E-14]
+    singular = np.sqrt(eigenvalues[keep])
+    coefficients = eigenvectors[:, keep] * singular
+    basis = np.zeros((len(keep), length))
+    compressed = {'mean': mean, 'components': basis, 'coefficients': coefficients, 'logSpace': logSpace,
+                  'floor': floor}
+    maxError = 0
+    squaredError = 0
+    for chunk in chunks:
+        basis[:, chunk] = eigenvectors[:, keep].T @ (values(chunk) - mean[chunk]) / singular[:, np.newaxis]
+        error = reconstructRows(compressed, coefficients, chunk.start, chunk.stop) - rows[:, chunk]
+        maxError = max(maxError, np.max(np.abs(error)))
+        squaredError += np.sum(error**2)
+    compressed['maxError'] = maxError / peak
+    compressed['rmsError'] = np.sqrt(squaredError / rows.size) / peak
+    return compressed
+
+
+def reconstructRows(compressed, coefficients, low=0, high=None):
+    # cross sections between samples low and high from the coefficients of one or more rows. Linear
+    # reconstructions can dip under 0 in the wings and are clipped there.
+    values = compressed['mean'][low:high] + coefficients @ compressed['components'][:, low:high]
+    if compressed['logSpace']:
+        values = np.exp(values)
+        values[values <= compressed['floor']] = 0
+        return values
+    return np.maximum(values, 0)
+
+
+def compressionRatio(compressed):
+    # size of the uncompressed rows over the size of the compressed table
+    rowCount, components = compressed['coefficients'].shape
+    length = len(compressed['mean'])
+    return rowCount * length / ((components + 1) * length + rowCount * components)
+
+
+def compressTable(name, components=COMPRESSION_COMPONENTS, logSpace=False):
+    # compresses a saved table into a .pca.npz file next to it and loads it in place of the full table
+    tablePath, axesPath = lookupPaths(name)
+    if not os.path.isfile(tablePath) or not os.path.isfile(axesPath):
+        print('No lookup table named %s in %s' % (name, lookupDir))
+        return False
+    crossSection = np.load(tablePath, mmap_mode='r')
+    temperatureCount, pressureCount, length = crossSection.shape
+    compressed = compressRows(crossSection.reshape(temperatureCount * pressureCount, length), components, logSpace)
+    np.savez(compressedPath(name), mean=compressed['mean'], components=compressed['components'],
+             coefficients=compressed['coefficients'].reshape(temperatureCount, pressureCount, -1),
+             logSpace=logSpace, floor=compressed['floor'], maxError=compressed['maxError'],
+             rmsError=compressed['rmsError'])
+    print('Compressed %s to %s components, %.1fx smaller. Largest error %.2e, rms error %.2e of the peak'
+          % (name, compressed['components'].shape[0], compressionRatio(compressed), compressed['maxError'],
+             compressed['rmsError']))
+    loadCompressedTable(name)
+    return compressed
+
+
+def compressedPath(name):
+    return '%s.pca.npz' % lookupPaths(name)[0][:-len('.npy')]
+
+
+def loadCompressedTable(name):
+    # registers a compressed table for its isotope, the same way as loadTable. Returns the global isotope id.
+    axesPath = lookupPaths(name)[1]
+    if not os.path.isfile(compressedPath(name)) or not os.path.isfile(axesPath):
+        print('No compressed lookup table named %s in %s' % (name, lookupDir))
+        return False
+    table = readAxes(name)
+    if not table:
+        return False
+    data = np.load(compressedPath(name))
+    table['compressed'] = {'mean': data['mean'],
+                           'components': data['components'],
+                           'coefficients': data['coefficients'],
+                           'logSpace': bool(data['logSpace']),
+                           'floor': float(data['floor'])}
+    registerTable(table)
+    return table['globalIsoId']
+
+
+def bracket(axis, value):
+    # the node below value on a sorted axis and the weight of the node above it
+    if len(axis) == 1:
+        return 0, 0
+    lower = int(np.clip(np.searchsorted(axis, value, 'right') - 1, 0, len(axis) - 2))
+    return lower, (value - axis[lower]) / (axis[lower + 1] - axis[lower])
+
+
+def interpolateTable(table, T, P, wavenumbers):
+    # bilinear in temperature and log pressure, then linear in wavenumber onto wavenumbers. Compressed tables
+    # interpolate their coefficients instead, then reconstruct only the samples needed.
+    # Returns None when T, P or the wavenumbers fall outside of the table.
+    logP = np.log(P)
+    if not table['temperature'][0] <= T <= table['temperature'][-1] or \
+            not table['logPressure'][0] <= logP <= table['logPressure'][-1] or \
+            np.min(wavenumbers) < table['wavenumber'][0] or np.max(wavenumbers) > table['wavenumber'][-1]:
+        return None
+    tIndex, tWeight = bracket(table['temperature'], T)
+    pIndex, pWeight = bracket(table['logPressure'], logP)
+    low = max(np.searchsorted(table['wavenumber'], np.min(wavenumbers)) - 1, 0)
+    high = min(np.searchsorted(table['wavenumber'], np.max(wavenumbers), 'right') + 1, len(table['wavenumber']))
+    if 'compressed' in table:
+        grid = table['compressed']['coefficients']
+    else:
+        grid = table['crossSection'][:, :, low:high]
+    values = 0
+    for tStep, tFraction in ((0, 1 - tWeight), (1, tWeight)):
+        for pStep, pFraction in ((0, 1 - pWeight), (1, pWeight)):
+            if tFraction * pFraction:
+                values = values + tFraction * pFraction * grid[tIndex + tStep, pIndex + pStep]
+    if 'compressed' in table:
+        values = reconstructRows(table['compressed'], values, low, high)
+    return np.interp(wavenumbers, table['wavenumber'][low:high], values)
+
+
+def matchingTables(globalIsoId, method, cutoffThreshold, relativeCutoff):
+    # the loaded tables of an isotope built with method and these cutoffs, the most recently loaded first
+    return [table for table in reversed(list(lookupTables.get(globalIsoId, {}).values()))
+            if (table['method'], table['cutoffThreshold'], table['relativeCutoff']) ==
+            (method, cutoffThreshold, relativeCutoff)]
+
+
+def lookupCrossSection(tables, T, P, wavenumbers):
+    # the cross section from the first of tables that covers T, P and the wavenumbers, or None if none does
+    for table in tables:
+        crossSection = interpolateTable(table, T, P, wavenumbers)
+        if crossSection is not None:
+            return crossSection
+    return None
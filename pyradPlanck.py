@@ -39,11 +39,18 @@ def planckWavenumber(n, temp):
     # planck blackbody intensity
     # input is wavenumber in meters, output is wm-2sr-1(cm-1)-1
     a = 2E8 * h * c**2 * n**3
-    b = 100 * h * c * n / k / float(temp)
+    b = 100 * h * c * n / k / np.asarray(temp, dtype=float)
     intensity = planck(a, b)
     return intensity
 
 
+def planckTemperatureDerivative(n, temp):
+    # d planckWavenumber / dT, wm-2sr-1(cm-1)-1K-1, with n in cm-1 as for planckWavenumber
+    temp = np.asarray(temp, dtype=float)
+    b = 100 * h * c * n / k / temp
+    return planckWavenumber(n, temp) * b / temp / -np.expm1(-b)
+
+
 def reverseWavenumber(n, intensity):
     pass
 
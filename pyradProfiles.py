@@ -0,0 +1,127 @@
+import numpy as np
+
+#   vertical profiles of temperature and mixing ratio, and the layers they are split into. A profile is a dict
+#   of altitude (km), temperature (K) and ppm, {molecule short name: ppm}, at the same nodes, with the surface
+#   pressure (mbar) or a pressure at every node. The standard profiles are piecewise linear fits of the US 1976
+#   standard atmosphere and the AFGL tropical and subarctic temperature profiles, with water vapor falling off
+#   exponentially, an ozone layer and well mixed gases at present day amounts.
+
+R = 8.314462618
+g0 = 9.80665
+airMolarMass = .0289644
+
+#   altitude steps (km) of the standard profiles and of the hydrostatic integration
+PROFILE_STEP = .1
+
+#   temperature breakpoints (km, K), surface pressure (mbar), water vapor at the surface (ppm), its scale height
+#   (km) and the least it drops to, and the ozone peak (ppm, km, width in km)
+STANDARD_PROFILES = {'us1976': {'temperature': ((0, 288.15), (11, 216.65), (20, 216.65), (32, 228.65),
+                                                (47, 270.65), (51, 270.65), (71, 214.65), (86, 186.87)),
+                                'surfacePressure': 1013.25,
+                                'h2o': (7750, 2.4, 4),
+                                'o3': (7.8, 32, 8)},
+                     'tropical': {'temperature': ((0, 299.7), (5, 270.3), (10, 237.0), (15, 203.7), (17, 194.8),
+                                                  (20, 206.7), (25, 221.4), (30, 232.3), (40, 254.0), (50, 270.2),
+                                                  (70, 219.0), (86, 190.0)),
+                                  'surfacePressure': 1013.0,
+                                  'h2o': (25900, 2.6, 4),
+                                  'o3': (8.0, 30, 7)},
+                     'subarcticSummer': {'temperature': ((0, 287.2), (5, 260.1), (10, 225.2), (23, 225.2),
+                                                         (30, 235.1), (47, 277.2), (50, 274.0), (70, 218.0),
+                                                         (86, 180.0)),
+                                         'surfacePressure': 1010.0,
+                                         'h2o': (11900, 2.3, 4),
+                                         'o3': (6.5, 30, 9)},
+                     'subarcticWinter': {'temperature': ((0, 257.2), (1, 259.1), (5, 240.9), (9, 217.2),
+                                                         (25, 217.2), (30, 220.0), (50, 265.7), (70, 230.0),
+                                                         (86, 200.0)),
+                                         'surfacePressure': 1013.0,
+                                         'h2o': (1410, 2.0, 4),
+                                         'o3': (6.0, 27, 10)}}
+
+#   well mixed gases, ppm
+WELL_MIXED = {'co2': 415., 'ch4': 1.9, 'n2o': .33}
+
+
+def standardProfile(name):
+    # one of STANDARD_PROFILES at PROFILE_STEP km nodes
+    if name not in STANDARD_PROFILES:
+        print('No standard profile named %s. Choose from %s' % (name, ', '.join(STANDARD_PROFILES)))
+        return False
+    definition = STANDARD_PROFILES[name]
+    breakpoints = np.array(definition['temperature'], dtype=float)
+    altitude = np.arange(0, breakpoints[-1, 0] + PROFILE_STEP / 2, PROFILE_STEP)
+    surfaceH2O, scaleHeight, leastH2O = definition['h2o']
+    peakO3, peakAltitude, widthO3 = definition['o3']
+    ppm = {'h2o': np.maximum(surfaceH2O * np.exp(-altitude / scaleHeight), leastH2O),
+           'o3': peakO3 * np.exp(-((altitude - peakAltitude) / widthO3)**2) + .03}
+    for molecule, value in WELL_MIXED.items():
+        ppm[molecule] = np.full(len(altitude), value)
+    return {'name': name,
+            'altitude': altitude,
+            'temperature': np.interp(altitude, breakpoints[:, 0], breakpoints[:, 1]),
+            'surfacePressure': definition['surfacePressure'],
+            'ppm': ppm}
+
+
+def readProfileFile(filePath):
+    # a profile from a csv file with a header row: altitude (km), temperature (K), optionally pressure (mbar),
+    # then one column of ppm per molecule, named by its short name. Without a pressure column the surface
+    # pressure is taken as 1013.25 mbar.
+    try:
+        data = np.genfromtxt(filePath, delimiter=',', names=True)
+    except OSError:
+        print('Could not read profile file %s' % filePath)
+        return False
+    columns = [column.lower() for column in data.dtype.names]
+    if 'altitude' not in columns or 'temperature' not in columns:
+        print('Profile file %s needs altitude and temperature columns' % filePath)
+        return False
+    order = np.argsort(data[data.dtype.names[columns.index('altitude')]])
+    profile = {'name': filePath, 'ppm': {}}
+    for name, column in zip(data.dtype.names, columns):
+        if column in ('altitude', 'temperature', 'pressure'):
+            profile[column] = np.atleast_1d(data[name])[order]
+        else:
+            profile['ppm'][column] = np.atleast_1d(data[name])[order]
+    if 'pressure' not in profile:
+        profile['surfacePressure'] = 1013.25
+    return profile
+
+
+def pressureAt(profile, altitudes):
+    # pressure (mbar) at altitudes (km), from the profile pressures or by integrating the hydrostatic equation
+    # up from the surface pressure
+    if 'pressure' in profile:
+        return np.exp(np.interp(altitudes, profile['altitude'], np.log(profile['pressure'])))
+    altitude = np.arange(profile['altitude'][0], profile['altitude'][-1] + PROFILE_STEP / 2, PROFILE_STEP)
+    inverseScaleHeight = airMolarMass * g0 / R / np.interp(altitude, profile['altitude'], profile['temperature'])
+    logPressure = np.log(profile['surfacePressure']) - np.concatenate(
+        ([0], np.cumsum((inverseScaleHeight[1:] + inverseScaleHeight[:-1]) / 2 * PROFILE_STEP * 1000)))
+    return np.exp(np.interp(altitudes, altitude, logPressure))
+
+
+def layerProfile(profile, layerCount=30, top=None):
+    # splits the profile from its lowest node up to top (km) into layerCount layers of equal log pressure.
+    # Returns a list of dicts, surface first, of depth (cm), T (K), P (mbar) and ppm for each layer. T is the
+    # profile at the layer's middle in log pressure and P the pressure there, and the depth is the hypsometric
+    # thickness of the layer at that temperature.
+    bottom = profile['altitude'][0]
+    if top is None:
+        top = profile['altitude'][-1]
+    altitude = np.arange(bottom, top + PROFILE_STEP / 2, PROFILE_STEP)
+    logPressure = np.log(pressureAt(profile, altitude))
+    edges = np.linspace(logPressure[0], logPressure[-1], layerCount + 1)
+    middles = (edges[1:] + edges[:-1]) / 2
+    # log pressure falls with altitude, np.interp needs it increasing
+    middleAltitude = np.interp(middles, logPressure[::-1], altitude[::-1])
+    temperatures = np.interp(middleAltitude, profile['altitude'], profile['temperature'])
+    depths = R * temperatures / airMolarMass / g0 * (edges[:-1] - edges[1:]) * 100
+    layers = []
+    for i in range(layerCount):
+        layers.append({'depth': float(depths[i]),
+                       'T': float(temperatures[i]),
+                       'P': float(np.exp(middles[i])),
+                       'ppm': {molecule: float(np.interp(middleAltitude[i], profile['altitude'], values))
+                               for molecule, values in profile['ppm'].items()}})
+    return layers
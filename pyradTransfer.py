@@ -0,0 +1,114 @@
+import numpy as np
+
+pi = 3.141592653589793
+
+#   radiative transfer through a stack of layers, layers x wavenumbers, with layer 0 at the surface. Level j is
+#   the boundary under layer j, so level 0 is the surface and level L the top of the atmosphere. Every sum along
+#   the path is taken in log space, as a cumulative logaddexp, so opaque paths underflow to 0 instead of
+#   overflowing, and the whole profile is solved without a loop over the layers.
+
+#   optical depths are clipped to this, which leaves exp(-tau) at 0 while keeping the log space sums exact
+OPTICAL_DEPTH_LIMIT = 1E6
+
+#   zenith angles the fluxes are integrated over
+FLUX_ANGLES = 4
+
+
+def levelOpticalDepths(opticalDepths):
+    # optical depth from the surface up to every level, (layers + 1) x wavenumbers
+    opticalDepths = np.minimum(np.nan_to_num(np.asarray(opticalDepths, dtype=float)), OPTICAL_DEPTH_LIMIT)
+    return np.concatenate((np.zeros((1, opticalDepths.shape[1])), np.cumsum(opticalDepths, axis=0)))
+
+
+def logSource(opticalDepths, layerRadiance):
+    # log of the radiance each layer emits out of its own boundaries, B * (1 - exp(-tau))
+    with np.errstate(divide='ignore'):
+        return np.log(layerRadiance * -np.expm1(-opticalDepths))
+
+
+def downwelling(depth, source):
+    # radiance going down at every level, from the level depths and layer sources along the path. Any leading
+    # axes, such as one per angle, are carried through. Level j gets the sum over layers i >= j of
+    # source_i * exp(-(depth_i - depth_j)).
+    downTerms = source - depth[..., :-1, :]
+    logDown = np.flip(np.logaddexp.accumulate(np.flip(downTerms, -2), axis=-2), -2) + depth[..., :-1, :]
+    return np.concatenate((np.exp(logDown), np.zeros(logDown.shape[:-2] + (1, logDown.shape[-1]))), axis=-2)
+
+
+def upwelling(depth, source, surfaceUp):
+    # radiance going up at every level, the surface term plus the layers i < j, each times
+    # exp(-(depth_j - depth_i+1))
+    with np.errstate(divide='ignore'):
+        surfaceTerm = np.broadcast_to(np.log(surfaceUp), depth.shape[:-2] + (1, depth.shape[-1]))
+    upTerms = np.concatenate((surfaceTerm, source + depth[..., 1:, :]), axis=-2)
+    return np.exp(np.logaddexp.accumulate(upTerms, axis=-2) - depth)
+
+
+def solveTransfer(opticalDepths, layerRadiance, surfaceRadiance, surfaceEmissivity=1, res=None, mu=1):
+    # radiances (W/m2/sr/cm-1) through layers with vertical opticalDepths and emitting layerRadiance, both
+    # layers x wavenumbers, above a surface emitting surfaceRadiance with surfaceEmissivity, along a path at
+    # cos(zenith angle) mu. The surface reflects 1 - surfaceEmissivity of the downwelling radiance. Returns a dict
+    # of the radiance going up and down at every level, the top of atmosphere radiance and the surface
+    # downwelling radiance. Fluxes are pi times the radiances, as in integrateSpectrum; with res, the level
+    # fluxes integrated over wavenumber (W/m2) are returned as well.
+    depth = levelOpticalDepths(opticalDepths) / mu
+    source = logSource(depth[1:] - depth[:-1], np.asarray(layerRadiance, dtype=float))
+    down = downwelling(depth, source)
+    surfaceUp = surfaceEmissivity * np.asarray(surfaceRadiance, dtype=float) + (1 - surfaceEmissivity) * down[0]
+    up = upwelling(depth, source, surfaceUp)
+    results = {'upwelling': up,
+               'downwelling': down,
+               'toaRadiance': up[-1],
+               'surfaceDownwelling': down[0]}
+    if res:
+        results['upwardFlux'] = np.sum(up, axis=1) * pi * res
+        results['downwardFlux'] = np.sum(down, axis=1) * pi * res
+        results['netFlux'] = results['upwardFlux'] - results['downwardFlux']
+    return results
+
+
+def toaJacobians(opticalDepths, layerRadiance, surfaceRadiance, surfaceEmissivity=1, mu=1):
+    # solveTransfer with the derivatives of the top of atmosphere radiance by the vertical optical depth and by
+    # the planck radiance of every layer, layers x wavenumbers, from the same forward pass. The radiance the
+    # surface reflects is held fixed.
+    results = solveTransfer(opticalDepths, layerRadiance, surfaceRadiance, surfaceEmissivity, mu=mu)
+    depth = levelOpticalDepths(opticalDepths) / mu
+    # transmittance from the top of each layer to the top of the atmosphere
+    above = np.exp(depth[1:] - depth[-1])
+    transmittance = np.exp(depth[:-1] - depth[1:])
+    results['byOpticalDepth'] = above * transmittance * (layerRadiance - results['upwelling'][:-1]) / mu
+    results['byLayerRadiance'] = above * -np.expm1(depth[:-1] - depth[1:])
+    return results
+
+
+def angleNodes(angles=FLUX_ANGLES):
+    # gauss-legendre nodes in cos(zenith angle) over 0 < mu <= 1, and their weights for the flux integral
+    # 2 pi * integral of I(mu) mu dmu
+    nodes, weights = np.polynomial.legendre.leggauss(angles)
+    mu = (nodes + 1) / 2
+    return mu, 2 * pi * weights / 2 * mu
+
+
+def angularFluxes(opticalDepths, layerRadiance, surfaceRadiance, surfaceEmissivity=1, res=None, angles=FLUX_ANGLES):
+    # spectral fluxes (W/m2/cm-1) at every level by gaussian quadrature over angles zenith angles, in place of
+    # the pi * radiance of the diffusivity approximation. The cumulative optical depths are computed once and
+    # scaled to every angle by broadcasting, so each angle costs one pass of the log space sums. The surface
+    # reflects 1 - surfaceEmissivity of the downwelling flux evenly in all directions. Returns the upward and
+    # downward spectral fluxes, the top of atmosphere radiance at each angle and the angles as mu; with res,
+    # the level fluxes integrated over wavenumber (W/m2) as well.
+    mu, weights = angleNodes(angles)
+    depth = levelOpticalDepths(opticalDepths)[np.newaxis] / mu[:, np.newaxis, np.newaxis]
+    source = logSource(depth[:, 1:] - depth[:, :-1], np.asarray(layerRadiance, dtype=float))
+    downFlux = np.tensordot(weights, downwelling(depth, source), axes=1)
+    surfaceUp = (surfaceEmissivity * np.asarray(surfaceRadiance, dtype=float)
+                 + (1 - surfaceEmissivity) * downFlux[0] / pi)
+    up = upwelling(depth, source, surfaceUp)
+    results = {'upwardSpectralFlux': np.tensordot(weights, up, axes=1),
+               'downwardSpectralFlux': downFlux,
+               'toaRadiance': up[:, -1],
+               'mu': mu}
+    if res:
+        results['upwardFlux'] = np.sum(results['upwardSpectralFlux'], axis=1) * res
+        results['downwardFlux'] = np.sum(downFlux, axis=1) * res
+        results['netFlux'] = results['upwardFlux'] - results['downwardFlux']
+    return results
@@ -112,35 +112,53 @@ def writeDictListToFile(dictionary, fullPath, comments=None, mode='wb'):
     openFile.close()
 
 
+def curveFilePaths(curveType, res):
+    # binary curve store: curve values appended back to back as raw float64 in <curveType>.bin,
+    # with an index of (key, offset, length) in <curveType>.idx.npy
+    resDirectory = '%s/res%s' % (curvesDir, res)
+    if not os.path.isdir(resDirectory):
+        os.makedirs(resDirectory)
+    return '%s/%s.bin' % (resDirectory, curveType), '%s/%s.idx.npy' % (resDirectory, curveType), \
+        '%s/%s.pyr' % (resDirectory, curveType)
+
+
+def readCurveIndex(indexPath):
+    if not os.path.isfile(indexPath):
+        return np.zeros(0, dtype=CURVE_INDEX_DTYPE)
+    return np.load(indexPath)
+
+
 def getCurves(curveType, res):
     curveDict = {}
-    resDirectory = '%s/res%s' % (curvesDir, res)
+    dataPath, indexPath, legacyPath = curveFilePaths(curveType, res)
     print('Retrieving %s curves...' % curveType, end='', flush=True)
-    if not os.path.isdir(resDirectory):
-        os.mkdir(resDirectory)
-    if curveType == 'voigt':
-        curveFilePath = '%s/voigt.pyr' % resDirectory
-    elif curveType == 'lorentz':
-        curveFilePath = '%s/lorentz.pyr' % resDirectory
-    elif curveType == 'gaussian':
-        curveFilePath = '%s/gaussian.pyr' % resDirectory
-    rows = openReturnLines(curveFilePath)
-    if rows:
-        for row in rows:
-            cells = row.strip().split(',')
-            key = cells.pop(0)
-            for i in range(0, len(cells) - 1):
-                if cells[i]:
-                    try:
-                        cells[i] = float(cells[i])
-                    except ValueError:
-                        print(cells[i])
-            cells.pop()
-            curveDict[key] = np.asarray(cells)
+    if not os.path.isfile(indexPath) and os.path.isfile(legacyPath):
+        convertLegacyCurveFile(curveType, res)
+    index = readCurveIndex(indexPath)
+    if len(index) > 0 and os.path.isfile(dataPath) and os.path.getsize(dataPath) > 0:
+        data = np.memmap(dataPath, dtype=np.float64, mode='r')
+        for key, offset, length in index:
+            curveDict[str(key)] = data[offset:offset + length]
     print('%s built from cache.' % len(curveDict))
     return curveDict
 
 
+def convertLegacyCurveFile(curveType, res):
+    # one time conversion of the old comma separated .pyr curve file into the binary store
+    dataPath, indexPath, legacyPath = curveFilePaths(curveType, res)
+    print('Converting %s to binary...' % legacyPath, end='', flush=True)
+    curveDict = {}
+    rows = openReturnLines(legacyPath)
+    if rows:
+        for row in rows:
+            cells = row.strip().strip(',').split(',')
+            try:
+                curveDict[cells[0]] = np.asarray(cells[1:], dtype=float)
+            except ValueError:
+                logToFile('could not convert curve row: %s' % row[:80])
+    writeCurveToFile(curveDict, curveType, res)
+
+
 def getMolParamsFromHitranFile():
     rows = openReturnLines(molParamsFile)
     isotopeInfo = {}
@@ -171,9 +189,10 @@ def getMolParamsFromHitranFile():
 
 
 def gatherData(globalIsoId, rangeMin, rangeMax):
+    # returns the lines of the isotope with rangeMin < wavenumber < rangeMax as arrays sorted by wavenumber,
+    # keyed by the Line attribute names. Missing segments are downloaded first.
     rangeList = []
     segment = int(rangeMin / 100) * 100
-    info = {}
     while segment < rangeMax:
         rangeList.append(segment)
         segment += 100
@@ -184,17 +203,96 @@ def gatherData(globalIsoId, rangeMin, rangeMax):
         filePath = '%s/%s/%s.pyr' % (dataDir, globalIsoId, segment)
         if not os.path.isfile(filePath):
             downloadHitran(filePath, globalIsoId, segment, segment + 100)
-        info.update(readHitranOnlineFile(filePath, rangeMin, rangeMax))
-        getQData(globalIsoId)
+    store = loadLineStore(globalIsoId)
+    low = np.searchsorted(store['nu'], rangeMin, 'right')
+    high = np.searchsorted(store['nu'], rangeMax, 'left')
+    info = {}
+    for attribute, column in LINE_ATTRIBUTES.items():
+        info[attribute] = np.array(store[column][low:high])
     return info
 
 
-def getQData(isotope):
-    qPath = cwd + '/data/%s/' % isotope
-    filePath = qPath + 'q%s.txt' % isotope
-    if not os.path.isfile(filePath):
-        downloadQData(isotope)
-    return readQFile(isotope)
+def lineStoreDir(globalIsoId):
+    return '%s/%s/lines' % (dataDir, globalIsoId)
+
+
+def segmentStamps(globalIsoId):
+    # the downloaded segment files of an isotope with their modification times and sizes, sorted by segment
+    globalIsoDir = '%s/%s' % (dataDir, globalIsoId)
+    stamps = []
+    if os.path.isdir(globalIsoDir):
+        for fileName in os.listdir(globalIsoDir):
+            if fileName.endswith('.pyr') and fileName[:-4].isdigit():
+                fileStat = os.stat('%s/%s' % (globalIsoDir, fileName))
+                stamps.append((int(fileName[:-4]), fileStat.st_mtime, fileStat.st_size))
+    return np.sort(np.array(stamps, dtype=LINE_STORE_SEGMENT_DTYPE), order='segment')
+
+
+def readHitranSegment(path):
+    # parses a downloaded segment into one row per line of the LINE_COLUMNS
+    rows = openReturnLines(path)
+    if not rows:
+        return np.zeros((0, len(LINE_COLUMNS)))
+    cells = np.loadtxt(rows, delimiter=',', ndmin=2)
+    return cells[:, 2:2 + len(LINE_COLUMNS)]
+
+
+def buildLineStore(globalIsoId, stamps):
+    # converts every downloaded segment of an isotope into one sorted .npy file per column. The segment stamps
+    # are written last, so a store that was interrupted while writing is rebuilt on the next load.
+    print('Building line store for isotope %s from %s segments' % (globalIsoId, len(stamps)))
+    storeDir = lineStoreDir(globalIsoId)
+    if not os.path.isdir(storeDir):
+        os.makedirs(storeDir)
+    segments = [readHitranSegment('%s/%s/%s.pyr' % (dataDir, globalIsoId, segment)) for segment in stamps['segment']]
+    lines = np.concatenate(segments + [np.zeros((0, len(LINE_COLUMNS)))])
+    lines = lines[np.argsort(lines[:, 0], kind='stable')]
+    for i, column in enumerate(LINE_COLUMNS):
+        np.save('%s/%s.tmp.npy' % (storeDir, column), np.ascontiguousarray(lines[:, i]))
+        os.replace('%s/%s.tmp.npy' % (storeDir, column), '%s/%s.npy' % (storeDir, column))
+    np.save('%s/segments.tmp.npy' % storeDir, stamps)
+    os.replace('%s/segments.tmp.npy' % storeDir, '%s/segments.npy' % storeDir)
+
+
+def loadLineStore(globalIsoId):
+    # memory maps the columnar line store of an isotope, rebuilding it first if a segment was added or changed
+    # since it was written
+    storeDir = lineStoreDir(globalIsoId)
+    stamps = segmentStamps(globalIsoId)
+    stampPath = '%s/segments.npy' % storeDir
+    if not os.path.isfile(stampPath) or not np.array_equal(np.load(stampPath), stamps):
+        buildLineStore(globalIsoId, stamps)
+    store = {}
+    for column in LINE_COLUMNS:
+        columnPath = '%s/%s.npy' % (storeDir, column)
+        if os.path.getsize(columnPath) > 128:
+            store[column] = np.load(columnPath, mmap_mode='r')
+        else:
+            store[column] = np.load(columnPath)
+    return store
+
+
+def getQTable(isotope):
+    # the partition function table of an isotope as arrays of temperature and Q. Each table is downloaded
+    # and read once per process and kept in qTables.
+    if isotope not in qTables:
+        filePath = cwd + '/data/%s/q%s.txt' % (isotope, isotope)
+        if not os.path.isfile(filePath):
+            downloadQData(isotope)
+        qTables[isotope] = readQFile(isotope)
+    return qTables[isotope]
+
+
+def partitionFunction(isotope, T):
+    # Q of an isotope at any temperature, or at an array of them (one per layer, say), linearly interpolated
+    # from the table. Temperatures outside of the table get its end values, with a warning the first time.
+    temperatures, q = getQTable(isotope)
+    if isotope not in qRangeWarnings and (np.any(np.asarray(T) < temperatures[0])
+                                          or np.any(np.asarray(T) > temperatures[-1])):
+        qRangeWarnings.add(isotope)
+        print('Temperature outside of the partition function table for isotope %s (%s-%sK)'
+              % (isotope, temperatures[0], temperatures[-1]))
+    return np.interp(T, temperatures, q)
 
 # downloads a table of isotopes and data from hitran
 def downloadMolParam():
@@ -418,47 +516,14 @@ def readQ(ID, isotopeDepth):
     return isoDict
 
 
-def readHitranOnlineFile(path, waveMin, waveMax):
-    isotope = 1
-    wavenumber = 2
-    intensity = 3
-    einsteinA = 4
-    airHalfwidth = 6
-    selfHalfwidth = 7
-    lowerEnergy = 5
-    tempExponent = 9
-    pressureShift = 8
-    lineListDict = {}
-    rows = openReturnLines(path)
-    if not rows:
-        return lineListDict
-    for row in rows:
-        cell = row.split(',')
-        if waveMin < float(cell[wavenumber]):
-            if float(cell[wavenumber]) < waveMax:
-                contents = {'isotope': int(cell[isotope]),
-                            'intensity': float(cell[intensity]),
-                            'einsteinA': float(cell[einsteinA]),
-                            'airHalfWidth': float(cell[airHalfwidth]),
-                            'selfHalfWidth': float(cell[selfHalfwidth]),
-                            'lowerEnergy': float(cell[lowerEnergy]),
-                            'tempExponent': float(cell[tempExponent]),
-                            'pressureShift': float(cell[pressureShift])}
-                lineListDict[float(cell[wavenumber])] = contents
-    return lineListDict
-
-
 def readQFile(isotope):
+    # returns the temperature and Q columns of a HITRAN q<iso>.txt table, sorted by temperature
     path = cwd + '/data/%s/q%s.txt' % (isotope, isotope)
-    if not os.path.isfile:
+    if not os.path.isfile(path):
         downloadQData(isotope)
-    openFile = open(path, 'r')
-    rows = openFile.readlines()
-    qDict = {}
-    for row in rows:
-        cell = row.split()
-        qDict[int(cell[0])] = float(cell[1])
-    return qDict
+    table = np.loadtxt(path, ndmin=2)
+    table = table[np.argsort(table[:, 0])]
+    return table[:, 0], table[:, 1]
 
 
 def readMolParams(globalIso):
@@ -478,15 +543,34 @@ def readMolParams(globalIso):
 
 
 def writeCurveToFile(curveDict, curveName, res):
-    resDirectory = '%s/res%s' % (curvesDir, res)
-    resFile = '%s/%s.pyr' % (resDirectory, curveName)
-    openFile = open(resFile, 'ab')
-    for key in curveDict:
-        openFile.write(bytes('%s,' % key, 'utf-8'))
-        for value in curveDict[key]:
-            openFile.write(bytes('%s,' % value, 'utf-8'))
-        openFile.write(bytes('\n', 'utf-8'))
+    # appends the curves whose keys are not stored yet. The values are appended to the data file first and the
+    # index is then swapped in with os.replace, so a reader only ever sees complete curves.
+    dataPath, indexPath, legacyPath = curveFilePaths(curveName, res)
+    index = readCurveIndex(indexPath)
+    storedKeys = set(str(key) for key in index['key'])
+    offset = 0
+    if len(index) > 0:
+        offset = int(np.max(index['offset'] + index['length']))
+    newEntries = []
+    openFile = open(dataPath, 'ab')
+    # anything past the indexed curves was left by an interrupted write and is dropped
+    openFile.truncate(offset * 8)
+    for key, curve in curveDict.items():
+        key = str(key)
+        if key in storedKeys:
+            continue
+        curve = np.ascontiguousarray(curve, dtype=np.float64)
+        openFile.write(curve.tobytes())
+        newEntries.append((key, offset, len(curve)))
+        storedKeys.add(key)
+        offset += len(curve)
     openFile.close()
+    if newEntries:
+        index = np.concatenate((index, np.array(newEntries, dtype=CURVE_INDEX_DTYPE)))
+        tempPath = '%s.tmp.npy' % indexPath[:-len('.npy')]
+        np.save(tempPath, index)
+        os.replace(tempPath, indexPath)
+    return len(newEntries)
 
 
 def displayAllMolecules():
@@ -801,6 +885,19 @@ def mergeArray(newX, oldX, oldY):
     return np.asarray(newY)
 
 
+# partition function tables read so far, keyed by global isotope id, see getQTable
+qTables = {}
+# isotopes already warned of a temperature outside of their partition function table, see partitionFunction
+qRangeWarnings = set()
+# columns of the downloaded line files from nu on, as stored in the columnar line store, and the Line
+# attribute each one becomes
+LINE_COLUMNS = ['nu', 'sw', 'a', 'elower', 'gamma_air', 'gamma_self', 'delta_air', 'n_air']
+LINE_ATTRIBUTES = {'wavenumber': 'nu', 'intensity': 'sw', 'einsteinA': 'a', 'airHalfWidth': 'gamma_air',
+                   'selfHalfWidth': 'gamma_self', 'lowerEnergy': 'elower', 'tempExponent': 'n_air',
+                   'pressureShift': 'delta_air'}
+LINE_STORE_SEGMENT_DTYPE = [('segment', 'i8'), ('mtime', 'f8'), ('size', 'i8')]
+CURVE_INDEX_DTYPE = [('key', 'U32'), ('offset', 'i8'), ('length', 'i8')]
+
 RES_MULTIPLIER = 1
 BASE_RESOLUTION = .01 * RES_MULTIPLIER
 
@@ -0,0 +1,232 @@
+import os
+import sys
+import types
+import numpy as np
+import pytest
+import pyradTransfer
+
+#   pyradUtilities takes its data directory from the working directory when it is imported, and expects a params
+#   file for every isotope there. The tests run in a temporary directory with a small synthetic line list for
+#   h2o and co2, so nothing is downloaded.
+
+#   global isotope id: short name, molecule id, q296, mass and the exponent of Q(T) = q296 * (T / 296)^n
+TEST_ISOTOPES = {1: ('h2o', 1, 174.58, 18.0106, 1.5),
+                 7: ('co2', 2, 286.09, 43.9898, 1.0)}
+GLOBAL_ISO_COUNT = 129
+
+
+def writeData(dataDir):
+    os.makedirs('%s/xsc' % dataDir)
+    os.makedirs('%s/curves' % dataDir)
+    rng = np.random.default_rng(0)
+    for globalIso in range(1, GLOBAL_ISO_COUNT + 1):
+        name, moleculeId, q296, molMass, qExponent = TEST_ISOTOPES.get(globalIso, ('x', 0, 100., 30., 1.))
+        isoDir = '%s/%s' % (dataDir, globalIso)
+        os.makedirs(isoDir)
+        with open('%s/params.pyr' % isoDir, 'w') as paramsFile:
+            paramsFile.write('%s,%s,%s,1,0.99,%s,1,%s\n' % (globalIso, name, moleculeId, q296, molMass))
+        if globalIso not in TEST_ISOTOPES:
+            continue
+        temperatures = np.arange(1., 3001.)
+        np.savetxt('%s/q%s.txt' % (isoDir, globalIso), np.c_[temperatures, q296 * (temperatures / 296)**qExponent],
+                   fmt=('%d', '%.8g'))
+        for segment in range(400, 900, 100):
+            count = 200
+            rows = np.c_[np.full(count, moleculeId), np.ones(count),
+                         np.sort(rng.uniform(segment, segment + 100, count)),
+                         10**rng.uniform(-23, -19, count), rng.uniform(0, 1, count), rng.uniform(0, 2000, count),
+                         rng.uniform(.05, .1, count), rng.uniform(.1, .4, count), rng.uniform(-.003, 0, count),
+                         rng.uniform(.6, .8, count)]
+            np.savetxt('%s/%s.pyr' % (isoDir, segment), rows, delimiter=',', fmt='%.8g')
+
+
+@pytest.fixture(scope='module')
+def pyrad(tmp_path_factory):
+    workDir = tmp_path_factory.mktemp('pyrad')
+    writeData(workDir / 'data')
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    # pyradInteractive starts its menu when imported
+    sys.modules.setdefault('pyradInteractive', types.ModuleType('pyradInteractive'))
+    import pyradClasses
+    yield pyradClasses
+    os.chdir(cwd)
+
+
+def test_addMolecule(pyrad):
+    layer = pyrad.Layer(10, 296, 1013.25, 600, 700)
+    molecule = layer.addMolecule('co2', 1, ppm=400)
+    isotope = molecule[0]
+    assert len(isotope) > 0
+    assert [line.wavenumber for line in isotope] == list(isotope.lineTable.wavenumber)
+    assert np.all((isotope.lineTable.wavenumber > layer.effectiveRangeMin)
+                  & (isotope.lineTable.wavenumber < layer.effectiveRangeMax))
+
+
+@pytest.mark.parametrize('P', [1013.25, 50])
+def test_tilesMatchUntiled(pyrad, P):
+    crossSections = []
+    for tileWidth in (pyrad.pyradCrossSection.TILE_WIDTH, None):
+        layer = pyrad.Layer(10, 250, P, 600, 700, tileWidth=tileWidth)
+        layer.addMolecule('co2', 1, ppm=400)
+        crossSections.append(pyrad.getCrossSection(layer))
+    assert len(crossSections[0]) == len(layer.xAxis)
+    np.testing.assert_allclose(crossSections[0], crossSections[1], rtol=0, atol=1E-9 * np.max(crossSections[1]))
+
+
+def test_lookupTable(pyrad):
+    pyrad.buildLookupTable('h2o', 600, 700, [200, 250, 300], [50, 300, 1000])
+    layer = pyrad.Layer(10, 250, 50, 600, 700)
+    layer.addMolecule('h2o', 1, ppm=1)
+    isotope = layer[0][0]
+    np.testing.assert_allclose(isotope.lookupCrossSection(), isotope.computeCrossSection('direct'), rtol=1E-12)
+    # self broadening at percent level moves the widths past CONCENTRATION_WIDTH_TOLERANCE
+    layer[0].setPercentage(4)
+    assert isotope.lookupCrossSection() is None
+    layer[0].setPPM(1)
+    layer.changeCrossSectionMethod('fft')
+    assert isotope.lookupCrossSection() is None
+    layer.changeCrossSectionMethod('direct')
+    # a table for another range is kept next to the first
+    pyrad.buildLookupTable('h2o', 700, 800, [200, 250, 300], [50, 300, 1000])
+    np.testing.assert_allclose(isotope.lookupCrossSection(), isotope.computeCrossSection('direct'), rtol=1E-12)
+    pyrad.pyradLookup.lookupTables.clear()
+
+
+def test_batchedMatchesLayers(pyrad):
+    crossSections = []
+    for batched in (True, False):
+        atmosphere = pyrad.Atmosphere('test')
+        for T, P in ((288, 1000), (260, 600), (230, 300), (215, 100)):
+            layer = atmosphere.addLayer(1E5, T, P, 600, 700)
+            layer.addMolecule('co2', 1, ppm=400)
+            layer.addMolecule('h2o', 1, ppm=3000)
+        atmosphere.createCrossSections(batched=batched)
+        if batched:
+            assert all(isotope.tilesCached('direct') for layer in atmosphere for molecule in layer
+                       for isotope in molecule)
+        crossSections.append(np.array([pyrad.getCrossSection(layer) for layer in atmosphere]))
+    np.testing.assert_allclose(crossSections[0], crossSections[1], rtol=0, atol=1E-9 * np.max(crossSections[1]))
+
+
+@pytest.mark.parametrize('P', [1013.25, 50])
+def test_temperatureDerivative(pyrad, P):
+    def absCoef(T):
+        layer = pyrad.Layer(10, T, P, 600, 700, cutoffThreshold=None)
+        layer.addMolecule('co2', 1, ppm=400)
+        return layer, pyrad.getAbsCoef(layer)
+
+    layer, _ = absCoef(250)
+    difference = (absCoef(250.5)[1] - absCoef(249.5)[1])
+    np.testing.assert_allclose(layer.absCoefTemperatureDerivative(), difference, rtol=0,
+                               atol=1E-3 * np.max(np.abs(difference)))
+
+
+@pytest.mark.parametrize('edit', ['changeTemperature', 'changeCrossSectionMethod'])
+def test_parallelAfterEdit(pyrad, capsys, edit):
+    value = {'changeTemperature': 280, 'changeCrossSectionMethod': 'twogrid'}[edit]
+    layer = pyrad.Layer(10, 250, 500, 600, 700, workers=2)
+    layer.addMolecule('co2', 1, ppm=400)
+    layer.addMolecule('h2o', 1, ppm=3000)
+    pyrad.getCrossSection(layer)
+    capsys.readouterr()
+    getattr(layer, edit)(value)
+    parallel = pyrad.getCrossSection(layer)
+    assert 'on 2 workers' in capsys.readouterr().out
+    serial = pyrad.Layer(10, 250, 500, 600, 700)
+    serial.addMolecule('co2', 1, ppm=400)
+    serial.addMolecule('h2o', 1, ppm=3000)
+    getattr(serial, edit)(value)
+    np.testing.assert_allclose(parallel, pyrad.getCrossSection(serial), rtol=0,
+                               atol=1E-9 * np.max(pyrad.getCrossSection(serial)))
+
+
+def test_changeCutoff(pyrad):
+    layer = pyrad.Layer(10, 250, 500, 600, 700)
+    layer.addMolecule('co2', 1, ppm=400)
+    relative = pyrad.getCrossSection(layer)
+    layer.changeCutoff(1E-22, relativeCutoff=False)
+    absolute = pyrad.getCrossSection(layer)
+    assert not np.array_equal(relative, absolute)
+    # the kind of threshold is kept unless given
+    layer.changeCutoff(None)
+    assert layer.cutoffThreshold is None and not layer.relativeCutoff
+    assert not np.array_equal(pyrad.getCrossSection(layer), absolute)
+
+
+def test_bandPower(pyrad):
+    layer = pyrad.Layer(1E4, 250, 500, 600, 700)
+    layer.addMolecule('co2', 1, ppm=400)
+    bandEdges = np.array([600., 650., 700.])
+    kPower = layer.bandPower(bandEdges, 288)
+    assert kPower.shape == (2,)
+    comparedPower, lblPower = layer.bandPower(bandEdges, 288, compare=True)
+    np.testing.assert_array_equal(kPower, comparedPower)
+    np.testing.assert_allclose(kPower, lblPower, rtol=1E-2)
+
+
+def transferProfile(seed=1, layers=6, wavenumbers=40):
+    rng = np.random.default_rng(seed)
+    return (10**rng.uniform(-3, 1.5, (layers, wavenumbers)), rng.uniform(.5, 1.5, (layers, wavenumbers)),
+            rng.uniform(.5, 1.5, wavenumbers))
+
+
+@pytest.mark.parametrize('surfaceEmissivity, mu', [(1, 1), (.8, .6)])
+def test_solveTransferRecursion(surfaceEmissivity, mu):
+    opticalDepths, layerRadiance, surfaceRadiance = transferProfile()
+    results = pyradTransfer.solveTransfer(opticalDepths, layerRadiance, surfaceRadiance, surfaceEmissivity, mu=mu)
+    # layer by layer, down from the top and back up from the surface
+    transmittance = np.exp(-opticalDepths / mu)
+    down = [np.zeros(opticalDepths.shape[1])]
+    for layer in reversed(range(len(opticalDepths))):
+        down.insert(0, down[0] * transmittance[layer] + layerRadiance[layer] * (1 - transmittance[layer]))
+    up = [surfaceEmissivity * surfaceRadiance + (1 - surfaceEmissivity) * down[0]]
+    for layer in range(len(opticalDepths)):
+        up.append(up[-1] * transmittance[layer] + layerRadiance[layer] * (1 - transmittance[layer]))
+    np.testing.assert_allclose(results['downwelling'], down, rtol=1E-10)
+    np.testing.assert_allclose(results['upwelling'], up, rtol=1E-10)
+
+
+def test_isothermalBlackAtmosphere():
+    opticalDepths = transferProfile()[0]
+    planck = np.linspace(.5, 1.5, opticalDepths.shape[1])
+    layerRadiance = np.broadcast_to(planck, opticalDepths.shape)
+    results = pyradTransfer.solveTransfer(opticalDepths, layerRadiance, planck, res=.01)
+    levels = np.broadcast_to(planck, (len(opticalDepths) + 1, len(planck)))
+    np.testing.assert_allclose(results['upwelling'], levels, rtol=1E-12)
+    np.testing.assert_allclose(results['toaRadiance'], planck, rtol=1E-12)
+    np.testing.assert_allclose(results['upwardFlux'], pyradTransfer.pi * np.sum(planck) * .01, rtol=1E-12)
+    fluxes = pyradTransfer.angularFluxes(opticalDepths, layerRadiance, planck)
+    np.testing.assert_allclose(fluxes['upwardSpectralFlux'], pyradTransfer.pi * levels, rtol=1E-12)
+
+
+def test_angularFluxes():
+    opticalDepths, layerRadiance, surfaceRadiance = transferProfile()
+    fluxes = [pyradTransfer.angularFluxes(opticalDepths, layerRadiance, surfaceRadiance, angles=angles)
+              for angles in (4, 32)]
+    for key in ('upwardSpectralFlux', 'downwardSpectralFlux'):
+        np.testing.assert_allclose(fluxes[0][key], fluxes[1][key], rtol=0, atol=2E-3 * np.max(fluxes[1][key]))
+    # one slab over a black surface at 0 K: upward flux 2 pi B * integral of (1 - exp(-tau / mu)) mu dmu
+    opticalDepth = np.array([[.01, .1, 1, 10]])
+    mu = (np.arange(200000) + .5) / 200000
+    exact = 2 * pyradTransfer.pi * np.sum((1 - np.exp(-opticalDepth.T / mu)) * mu, axis=1) / len(mu)
+    slab = pyradTransfer.angularFluxes(opticalDepth, np.ones((1, 4)), np.zeros(4), angles=32)
+    np.testing.assert_allclose(slab['upwardSpectralFlux'][-1], exact, rtol=1E-5)
+
+
+def test_toaJacobians():
+    opticalDepths, layerRadiance, surfaceRadiance = transferProfile(layers=4, wavenumbers=10)
+    opticalDepths = np.minimum(opticalDepths, 5)
+    mu = .7
+    results = pyradTransfer.toaJacobians(opticalDepths, layerRadiance, surfaceRadiance, mu=mu)
+    step = 1E-6
+    for layer in range(len(opticalDepths)):
+        for key, values in (('byOpticalDepth', opticalDepths), ('byLayerRadiance', layerRadiance)):
+            toa = []
+            for sign in (1, -1):
+                perturbed = values.copy()
+                perturbed[layer] += sign * step
+                arguments = {'byOpticalDepth': (perturbed, layerRadiance),
+                             'byLayerRadiance': (opticalDepths, perturbed)}[key]
+                toa.append(pyradTransfer.solveTransfer(*arguments, surfaceRadiance, mu=mu)['toaRadiance'])
+            np.testing.assert_allclose(results[key][layer], (toa[0] - toa[1]) / 2 / step, rtol=0, atol=1E-8)